@@ -1,16 +1,30 @@
 import re
 import sys
+from functools import partial
+from os.path import normpath
 from pathlib import Path
-from parxel.nodes import Node, Document, LexicalNode
-from parxel.token import Token, TK
-from parxel.parser import TextParser
+from typing import Iterable
+from parxel.lexer import Lexer, location, rebase
+from parxel.memory import footprint
+from parxel.nodes import Node, Document, LexicalNode, defer
+from parxel.token import Token, TK, TokenRegistry
+from parxel.parser import TextParser, release_tokens
 
 
 # Markdown specific tokens
-TK.TargetName = [TK.Number, TK.Word, TK.Period, TK.Slash, TK.Minus, TK.Colon]
-TK.Text = [TK.Space, TK.HorizontalTabulator, TK.Symbol, TK.Number, TK.Word, TK.ParanthesisOpen,
-           TK.ParanthesisClose, TK.Period, TK.Slash, TK.Minus, TK.QuotationMark, TK.Asterisk, TK.Colon]
-TK.ReferenceText = [TK.Number, TK.Word] + TK.Whitespaces
+MDTK = TokenRegistry(
+    operators=['```'],
+    coalesce=[TK.Space, TK.HorizontalTabulator],
+    CodeFence='```',
+    Code=[TK.Backtick, '```'],
+    TargetName=[TK.Number, TK.Word, TK.Period, TK.Slash, TK.Minus, TK.Colon],
+    Text=[TK.Space, TK.HorizontalTabulator, TK.Symbol, TK.Number, TK.Word, TK.ParanthesisOpen,
+          TK.ParanthesisClose, TK.Period, TK.Slash, TK.Minus, TK.QuotationMark, TK.Asterisk, TK.Colon],
+    ReferenceText=[TK.Number, TK.Word] + TK.Whitespaces,
+    PlainText=0xF3,  # Line without markdown syntax
+    CodeBlock=0xF4,  # Fenced code
+    TableBlock=0xF5  # Table parsed on first access
+)
 
 
 # Markdown specific nodes
@@ -27,9 +41,12 @@ class Heading(Node):
 
         self.level = 1
 
+    def hash(self, *tweak: str):
+        return super().hash(self.level, tweak)
+
 
 class Image(LexicalNode):
-    RE = re.compile(r'\!\[(.*)\]\((.*)\)')
+    RE = re.compile(r'\!\[(.*)\]\((.*)\)', re.DOTALL)
 
     def __init__(self, tokens: list, parent: Node = None):
         super().__init__(tokens, parent)
@@ -41,7 +58,7 @@ class Image(LexicalNode):
 
 
 class Reference(LexicalNode):
-    RE = re.compile(r'\[(.*)\]\((.*)\)')
+    RE = re.compile(r'\[(.*)\]\((.*)\)', re.DOTALL)
 
     def __init__(self, tokens: list, parent: Node = None):
         super().__init__(tokens, parent)
@@ -85,6 +102,9 @@ class Table(Node):
         self.columns = 0
         self.cell_alignment = []
 
+    def hash(self, *tweak: str):
+        return super().hash(self.columns, ','.join(self.cell_alignment), tweak)
+
 
 class TableRow(Node):
     def __init__(self, parent: Node = None):
@@ -96,8 +116,103 @@ class TableCell(Node):
         super().__init__(parent)
 
 
+class LinkIndex:
+    # Targets of the references and images of many documents, filled by MD while parsing.
+    # Nodes are kept with the document they are in, None for streams.
+    RE_EXTERNAL = re.compile(r'^[a-zA-Z][\w+.-]*:')
+
+    def __init__(self, root: Path = None):
+        self.root: Path | None = root  # Absolute targets are relative to root
+
+        self.targets: dict[str, dict[Node, Path | None]] = {}
+        self.paths: dict[Path, dict[Node, Path | None]] = {}  # Local files by resolved target
+        self.documents: dict[Path | None, list[Node]] = {}
+
+        # Resolved targets by directory and target, shared by the documents of a folder
+        self.resolved: dict[tuple[Path, str], Path | None] = {}
+
+    def __len__(self) -> int:
+        return sum(len(nodes) for nodes in self.documents.values())
+
+    def add(self, document: Path | None, node: Reference | Image) -> None:
+        self.targets.setdefault(node.target, {})[node] = document
+        self.documents.setdefault(document, []).append(node)
+
+        if path := self.resolve(document, node.target):
+            self.paths.setdefault(path, {})[node] = document
+
+    def add_tree(self, document: Path | None, root: Node) -> None:
+        # Links of a tree parsed without the index
+        for node in root.walk():
+            if isinstance(node, (Reference, Image)):
+                self.add(document, node)
+
+    def discard(self, document: Path | None) -> None:
+        # Forget the links of a document before it is parsed again or after it was removed
+        for node in self.documents.pop(document, []):
+            self.remove(self.targets, node.target, node)
+            if path := self.resolve(document, node.target):
+                self.remove(self.paths, path, node)
+
+    @staticmethod
+    def remove(index: dict, key, node: Node) -> None:
+        nodes = index[key]
+        del nodes[node]
+        if not nodes:
+            del index[key]
+
+    def update(self, changes) -> None:
+        # Forget removed documents after a corpus refresh, changed ones were parsed again
+        for document in changes.removed:
+            self.discard(document)
+
+    def resolve(self, document: Path | None, target: str) -> Path | None:
+        # Local file a target refers to, None for external targets
+        if self.RE_EXTERNAL.match(target):
+            return None
+
+        directory = document.parent if document else Path()
+        key = directory, target
+        if key not in self.resolved:
+            if target.startswith('/'):
+                path = (self.root or Path('/')) / target.lstrip('/')
+            else:
+                path = directory / target
+            self.resolved[key] = Path(normpath(path))
+        return self.resolved[key]
+
+    def links(self, document: Path | None) -> list[Node]:
+        return list(self.documents.get(document, []))
+
+    def linking(self, target: str | Path) -> list[Node]:
+        # Nodes with a target, or with any target resolving to a local file
+        nodes = self.paths.get(Path(normpath(target))) if isinstance(target, Path) else self.targets.get(target)
+        return list(nodes or [])
+
+    def referrers(self, target: str | Path) -> set[Path | None]:
+        # Documents linking to a target or a local file
+        nodes = self.paths.get(Path(normpath(target))) if isinstance(target, Path) else self.targets.get(target)
+        return set((nodes or {}).values())
+
+    def broken(self, files: Iterable[Path] = None) -> list[Node]:
+        # Nodes linking to local files that do not exist, each file is only looked up once
+        if files is not None:
+            existing = {Path(normpath(file)) for file in files}
+            missing = [path for path in self.paths if path not in existing]
+        else:
+            missing = [path for path in self.paths if not path.exists()]
+
+        return [node for path in missing for node in self.paths[path]]
+
+
 class MD(Document, TextParser):
     RE_ALGINMENT = re.compile('((:?-+:?)+)')
+    RE_BLOCK = re.compile(r'```|`|\[|\n\n')
+    RE_REFERENCE_TEXT = re.compile(r'\[[\w\s]*\]')
+    RE_PLAIN = re.compile('[^ \\-{0}][^{0}]*'.format(re.escape(''.join(c for c, type in MDTK.types.items()
+                                                                      if type not in MDTK.Text))))
+
+    registry = MDTK
 
     class State:
         Start, \
@@ -106,22 +221,161 @@ class MD(Document, TextParser):
             Table \
             = range(4)
 
-    def __init__(self, filepath: Path):
+    def __init__(self, filepath: Path = None, lazy: bool = False, links: LinkIndex = None, **options):
         Document.__init__(self, filepath=filepath)
-        TextParser.__init__(self, root=self, filepath=filepath)
+
+        # Fenced code is a single token and tables are parsed on first access
+        self.lazy: bool = lazy
+
+        # Links of a file replace those of an earlier parse
+        self.links: LinkIndex | None = links
+        if links is not None and filepath:
+            links.discard(filepath)
+
+        TextParser.__init__(self, root=self, filepath=filepath, **options)
 
         self.state: list[MD.State] = [MD.State.Start]
 
+    @classmethod
+    def parse_parallel(cls, filepath: Path = None, stream: str = None, root: Node = None, workers: int = None,
+                       chunk_size: int = 1 << 20, **options) -> Node:
+        # Workers would fill copies of the index, the links are taken from the stitched tree instead
+        links = options.pop('links', None)
+        filepath = Path(filepath) if filepath else None
+        root = super().parse_parallel(filepath, stream, root, workers, chunk_size, **options)
+
+        if links is not None:
+            if filepath:
+                links.discard(filepath)
+            links.add_tree(filepath, root)
+
+        return root
+
+    @classmethod
+    def split_blocks(cls, stream: str) -> list[int]:
+        # Blank lines outside of code and reference texts, the next block starts at the second line feed
+        offsets = []
+        fence = inline = False
+        reference = 0
+
+        for match in MD.RE_BLOCK.finditer(stream):
+            token = match.group()
+            if token == '```':
+                fence = fence if inline else not fence
+            elif token == '`':
+                inline = inline if fence else not inline
+            elif fence or inline:
+                continue
+            elif token == '[':
+                if text := MD.RE_REFERENCE_TEXT.match(stream, match.start()):
+                    reference = text.end()
+            elif match.start() >= reference:
+                offsets.append(match.start() + 1)
+
+        return offsets
+
+    def prescan(self, stream: str) -> list[tuple[int, int, int]]:
+        # Plain lines starting a paragraph and the plain lines following them become single tokens,
+        # in lazy mode also fenced code and tables starting a paragraph
+        spans = []
+        fence = inline = False
+        safe = True
+        reference = pos = 0
+
+        def scan(beg: int, end: int):
+            nonlocal fence, inline, reference
+            for match in MD.RE_BLOCK.finditer(stream, beg, end):
+                token = match.group()
+                if token == '```':
+                    fence = fence if inline else not fence
+                elif token == '`':
+                    inline = inline if fence else not inline
+                elif token == '[' and not (fence or inline):
+                    if text := MD.RE_REFERENCE_TEXT.match(stream, match.start()):
+                        reference = max(reference, text.end())
+
+        while pos <= len(stream):
+            eol = stream.find(TK.LineFeed, pos)
+            eol = len(stream) if eol < 0 else eol
+
+            if pos == eol:
+                safe = not (fence or inline) and pos >= reference
+            elif safe and MD.RE_PLAIN.fullmatch(stream, pos, eol):
+                spans.append((pos, eol, MDTK.PlainText))
+            elif safe and self.lazy and (block := self.scan_block(stream, pos, self.links is not None)):
+                spans.append(block)
+
+                # Rest of the line after the closing fence
+                end = block[1]
+                eol = stream.find(TK.LineFeed, end)
+                eol = len(stream) if eol < 0 else eol
+                if end < eol:
+                    safe = False
+                    scan(end, eol)
+            else:
+                safe = False
+                scan(pos, eol)
+
+            pos = eol + 1
+
+        return spans
+
+    @staticmethod
+    def scan_block(stream: str, pos: int, links: bool = False) -> tuple[int, int, int] | None:
+        if stream.startswith('```', pos):
+            end = stream.find('```', pos + 3)
+            return (pos, end + 3, MDTK.CodeBlock) if end >= 0 else None
+
+        if stream[pos] == TK.VerticalBar:
+            # Tables end at a blank line, unless code or a reference text continues past it
+            end = stream.find('\n\n', pos)
+            end = len(stream) if end < 0 else end
+            if stream.find(TK.Backtick, pos, end) >= 0:
+                return None
+
+            # Links are indexed while parsing
+            if links and stream.find(TK.SquareBracketOpen, pos, end) >= 0:
+                return None
+
+            i = stream.find(TK.SquareBracketOpen, pos, end)
+            while i >= 0:
+                if (text := MD.RE_REFERENCE_TEXT.match(stream, i)) and text.end() > end:
+                    return None
+                i = stream.find(TK.SquareBracketOpen, i + 1, end)
+
+            return pos, end, MDTK.TableBlock
+
+        return None
+
+    @classmethod
+    def parse_deferred(cls, rule: str, source: str, beg: int, end: int, retain_tokens: bool = True) -> Node:
+        # Parse a block of the source on its own, positions refer to the whole source
+        text = source[beg:end]
+        tokens = rebase(Lexer(stream=text, registry=cls.registry).tokenize(), beg, *location(source, beg))
+
+        parser = cls(tokens=tokens, stream=text)
+        getattr(parser, rule)()
+
+        node = parser.children[0]
+        if not retain_tokens:
+            release_tokens(node, source)
+        return node
+
     def parse_format(self):
         while self:
-            self.parse_nodes()
+            self.parse_block()
 
         return self.root
 
+    def parse_block(self):
+        self.parse_nodes()
+
     def parse_nodes(self):
         if self.state[-1] == MD.State.Start:
 
-            if self.get().type == TK.NumberSign:
+            if self.get().type == MDTK.PlainText:
+                self.parse_plain()
+            elif self.get().type == TK.NumberSign:
                 self.parse_heading()
             elif self.get().type == TK.Minus:
                 self.parse_list()
@@ -129,13 +383,13 @@ class MD(Document, TextParser):
                 self.parse_image()
             elif self.get().type == TK.SquareBracketOpen:
                 self.parse_reference()
-            elif self.get().type == TK.Backtick:
+            elif self.get().type in MDTK.Code or self.get().type == MDTK.CodeBlock:
                 self.parse_code()
-            elif self.get().type == TK.VerticalBar:
+            elif self.get().type in [TK.VerticalBar, MDTK.TableBlock]:
                 self.parse_table()
             elif self.get().type in [TK.LineFeed, TK.Space]:
                 self.discard()  # Discard newline or space at the start of a line
-            elif self.get().type in TK.Text:
+            elif self.get().type in MDTK.Text:
                 self.parse_text()
             else:
                 self.error(TK.Undefined)
@@ -143,9 +397,9 @@ class MD(Document, TextParser):
         elif self.state[-1] == MD.State.Heading:
             if self.get().type == TK.SquareBracketOpen:
                 self.parse_reference()
-            elif self.get().type == TK.Backtick:
+            elif self.get().type in MDTK.Code:
                 self.parse_code()
-            elif self.get().type in TK.Text:
+            elif self.get().type in MDTK.Text:
                 self.parse_text()
             elif self.get().type == TK.Space:
                 self.discard()  # Discard space at the start of the line
@@ -157,25 +411,25 @@ class MD(Document, TextParser):
         elif self.state[-1] == MD.State.List:
             if self.get().type == TK.SquareBracketOpen:
                 self.parse_reference()
-            elif self.get().type == TK.Backtick:
+            elif self.get().type in MDTK.Code:
                 self.parse_code()
             elif self.get().type == TK.Minus:
                 self.parse_list()
             elif self.get().type == TK.Space:
                 self.discard()  # Discard spaces at the start of the line
-            elif self.get().type in TK.Text:
+            elif self.get().type in MDTK.Text:
                 self.parse_text()
             else:
                 self.error(TK.Undefined)
 
         elif self.state[-1] == MD.State.Table:
-            if self.get().type in TK.Text:
+            if self.get().type in MDTK.Text:
                 self.parse_text()
             elif self.get().type == TK.ExclamationMark:
                 self.parse_image()
             elif self.get().type == TK.SquareBracketOpen:
                 self.parse_reference()
-            elif self.get().type == TK.Backtick:
+            elif self.get().type in MDTK.Code:
                 self.parse_code()
             elif self.get().type == TK.VerticalBar:
                 return
@@ -183,58 +437,82 @@ class MD(Document, TextParser):
                 self.error(TK.Undefined)
 
     def parse_text(self):
-        self.consume_while_any(TK.Text)
+        self.consume_while_any(MDTK.Text)
+
+        self.add_to_scope(Text(self.collect_tokens()))
+
+    def parse_plain(self):
+        self.next()
 
         self.add_to_scope(Text(self.collect_tokens()))
 
     def parse_image(self):
+        image = self.attempt(self.match_image)
+
+        if image:
+            self.add_to_scope(image)
+            if self.links is not None:
+                self.links.add(self.filepath, image)
+        else:
+            self.parse_literal()
+
+    def match_image(self) -> Image:
         self.consume_strict(TK.ExclamationMark)
 
         self.consume_strict(TK.SquareBracketOpen)
 
-        self.consume_while_any(TK.ReferenceText)
+        self.consume_while_any(MDTK.ReferenceText)
 
         self.consume_strict(TK.SquareBracketClose)
 
         self.consume_strict(TK.ParanthesisOpen)
 
-        self.consume_while_any(TK.TargetName)
+        self.consume_while_any(MDTK.TargetName)
 
         self.consume_strict(TK.ParanthesisClose)
 
-        self.add_to_scope(Image(self.collect_tokens()))
+        return Image(self.collect_tokens())
 
     def parse_reference(self):
+        reference = self.attempt(self.match_reference)
+
+        if reference:
+            self.add_to_scope(reference)
+            if self.links is not None:
+                self.links.add(self.filepath, reference)
+        else:
+            self.parse_literal()
+
+    def match_reference(self) -> Reference:
         self.consume_strict(TK.SquareBracketOpen)
 
-        self.consume_while_any(TK.ReferenceText)
+        self.consume_while_any(MDTK.ReferenceText)
 
         self.consume_strict(TK.SquareBracketClose)
 
         self.consume_strict(TK.ParanthesisOpen)
 
-        self.consume_while_any(TK.TargetName)
+        self.consume_while_any(MDTK.TargetName)
 
         self.consume_strict(TK.ParanthesisClose)
 
-        self.add_to_scope(Reference(self.collect_tokens()))
-
-    def parse_code(self):
-        is_block = False
-
-        self.consume(TK.Backtick)
-
-        if self.consume(TK.Backtick):
-            self.consume_strict(TK.Backtick)
-
-            is_block = True
+        return Reference(self.collect_tokens())
 
-        self.consume_until(TK.Backtick)
+    def parse_literal(self):
+        self.next()  # Keep the symbol that did not start a valid construct as text
+        self.consume_while_any(MDTK.Text)
 
-        self.next()
+        self.add_to_scope(Text(self.collect_tokens()))
 
-        if is_block:
+    def parse_code(self):
+        if self.consume(MDTK.CodeBlock):
+            pass
+        elif self.consume(MDTK.CodeFence):
+            self.consume_until(MDTK.CodeFence)
+            self.consume_strict(MDTK.CodeFence)
+        else:
             self.consume_strict(TK.Backtick)
+            self.consume_until(TK.Backtick)
             self.consume_strict(TK.Backtick)
 
         self.add_to_scope(Code(self.collect_tokens()))
@@ -242,13 +520,12 @@ class MD(Document, TextParser):
     def parse_heading(self):
         self.state.append(MD.State.Heading)
 
-        heading = Heading()
-        self.enter_scope(heading)
-
+        # The level is known before the heading is entered
         self.consume_while(TK.NumberSign)
 
-        tokens = self.collect_tokens()
-        heading.level = len(tokens)
+        heading = Heading()
+        heading.level = len(self.collect_tokens())
+        self.enter_scope(heading)
 
         while self and self.get().type != TK.LineFeed:
             self.parse_nodes()
@@ -265,6 +542,10 @@ class MD(Document, TextParser):
         while self and self.get().type != TK.LineFeed:
             self.parse_list_item()
 
+            # Leave the line feed before a blank line to enclosing lists
+            if self.peek() and self.peek().type == TK.LineFeed:
+                break
+
             self.discard()  # Discard line feed
 
         self.exit_scope()
@@ -284,6 +565,13 @@ class MD(Document, TextParser):
         self.exit_scope()
 
     def parse_table(self):
+        if self.get().type == MDTK.TableBlock:
+            token = self.discard()[0]
+            builder = partial(type(self).parse_deferred, 'parse_table', self.source, token.beg, token.end,
+                              self.retain_tokens)
+            self.add_to_scope(defer(Table, builder, extent=(token.beg, token.end), key=token.text))
+            return
+
         self.state.append(MD.State.Table)
 
         table = Table()
@@ -294,29 +582,44 @@ class MD(Document, TextParser):
 
             self.discard()  # Discard line feed
 
+            if len(table.children) == 1 and self:
+                self.parse_table_alignment(table)
+
         if len(table.children) > 0:
             table.columns = len(table.children[0].children)
 
-        if len(table.children) > 1:
-            for cell in table.children[1].children:
-                if len(cell.children) > 0 and hasattr(cell.children[0], 'text'):
-                    text = cell.children[0].text
-                    if re.search(r':-{3,}:', text):
-                        table.cell_alignment.append(Table.Align.center)
-                    elif text.find('---:') > -1:
-                        table.cell_alignment.append(Table.Align.right)
-                    else:
-                        table.cell_alignment.append(Table.Align.left)
-
-        if table.cell_alignment:
-            table.children.pop(1)
-        else:
+        if not table.cell_alignment:
             table.cell_alignment = [Table.Align.left] * table.columns
 
         self.exit_scope()
 
         self.state.pop()
 
+    def parse_table_alignment(self, table: Table):
+        # The row below the header only sets the alignment of the columns, it is not a node
+        mark = self.mark()
+        self.consume_until(TK.LineFeed)
+
+        text = ''.join(token.text for token in self.buffer[self.nend:self.pos])
+        cells = text.split(TK.VerticalBar)[1:]
+        if text.endswith(TK.VerticalBar):
+            cells.pop()
+
+        for cell in cells:
+            if not cell:
+                continue
+            if re.search(r':-{3,}:', cell):
+                table.cell_alignment.append(Table.Align.center)
+            elif cell.find('---:') > -1:
+                table.cell_alignment.append(Table.Align.right)
+            else:
+                table.cell_alignment.append(Table.Align.left)
+
+        if table.cell_alignment:
+            self.discard()  # Discard line feed
+        else:
+            self.reset(mark)
+
     def parse_table_row(self):
         row = TableRow()
         self.enter_scope(row)
@@ -332,7 +635,7 @@ class MD(Document, TextParser):
 
     def parse_table_cell(self):
         cell = TableCell()
-        self.add_to_scope(cell)
+        self.enter_scope(cell)
 
         while self and self.get().type != TK.VerticalBar:
             self.parse_nodes()
@@ -341,18 +644,29 @@ class MD(Document, TextParser):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        path = Path(sys.argv[1])
+    # --memory prints the memory footprint of the trees and the parsers instead of the trees
+    memory = '--memory' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--memory']
+
+    if len(args) == 1:
+        path = Path(args[0])
+        parsed = []
         if path.is_file():
             md = MD(filepath=path)
             node = md.parse()
+            parsed.append(md)
         else:
             for file in path.rglob('*.md'):
                 md = MD(filepath=file)
                 node = md.parse()
+                parsed.append(md)
     else:
         sys.exit(1)
 
+    if memory:
+        print(footprint(*parsed).dump())
+        sys.exit(0)
+
     print(node.dump(properties=True))
     print(node.dump())
 
@@ -0,0 +1,43 @@
+from time import monotonic
+
+
+class Budget:
+    class ExceededException(Exception):
+        def __init__(self, reason: str, partial = None, tokens: int = 0, nodes: int = 0):
+            super().__init__(f'Budget exceeded: {reason} after {tokens} tokens and {nodes} nodes')
+
+            # What was done so far, the tokens of a lexer or the tree of a parser
+            self.reason: str = reason
+            self.partial = partial
+            self.tokens: int = tokens
+            self.nodes: int = nodes
+
+    def __init__(self, timeout: float = None, max_tokens: int = None, max_nodes: int = None, interval: int = 1024):
+        # The deadline starts with the budget, one budget can cover lexing and parsing
+        self.deadline: float | None = None if timeout is None else monotonic() + timeout
+        self.max_tokens: int | None = max_tokens
+        self.max_nodes: int | None = max_nodes
+
+        # Characters lexed or parser steps between two checks
+        self.interval: int = interval
+
+        self.cancelled: bool = False
+
+    def cancel(self) -> None:
+        # Stop at the next check, from another thread or a signal handler
+        self.cancelled = True
+
+    def exceeded(self, tokens: int = 0, nodes: int = 0) -> str | None:
+        if self.cancelled:
+            return 'cancelled'
+        if self.max_tokens is not None and tokens > self.max_tokens:
+            return 'tokens'
+        if self.max_nodes is not None and nodes > self.max_nodes:
+            return 'nodes'
+        if self.deadline is not None and monotonic() >= self.deadline:
+            return 'timeout'
+        return None
+
+    def check(self, tokens: int = 0, nodes: int = 0, partial = None) -> None:
+        if reason := self.exceeded(tokens, nodes):
+            raise Budget.ExceededException(reason, partial, tokens, nodes)
@@ -0,0 +1,143 @@
+from hashlib import md5
+from logging import Logger, getLogger
+from pathlib import Path
+from threading import Event
+from typing import Callable
+
+from parxel.nodes import Node, Folder, Document
+
+
+logger = getLogger(__name__)
+
+
+class Entry:
+    def __init__(self, size: int, mtime: int, digest: str, document: Document):
+        self.size: int = size
+        self.mtime: int = mtime
+        self.digest: str = digest
+        self.document: Document = document
+
+
+class Changes:
+    def __init__(self):
+        self.added: list[Path] = []
+        self.changed: list[Path] = []
+        self.removed: list[Path] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+    def __repr__(self):
+        return f'Changes(added={len(self.added)}, changed={len(self.changed)}, removed={len(self.removed)})'
+
+
+class Corpus(Folder):
+    def __init__(self,
+        path: Path,
+        parser: Callable[[Path], Document],
+        pattern: str = '*.md',
+        parent: Node = None,
+        logger: Logger = logger):
+
+        Folder.__init__(self, path=Path(path), parent=parent)
+
+        self.parser = parser
+        self.pattern: str = pattern
+        self.logger = logger
+
+        # Path, size, mtime and content hash of every parsed document
+        self.manifest: dict[Path, Entry] = {}
+        self.folders: dict[Path, Folder] = {self.path: self}
+
+    def refresh(self) -> Changes:
+        changes = Changes()
+        seen: set[Path] = set()
+
+        for filepath in self.path.rglob(self.pattern):
+            if not filepath.is_file():
+                continue
+
+            seen.add(filepath)
+            stat = filepath.stat()
+            entry = self.manifest.get(filepath)
+
+            if entry and entry.size == stat.st_size and entry.mtime == stat.st_mtime_ns:
+                continue
+
+            digest = md5(filepath.read_bytes()).hexdigest()
+
+            if entry and entry.digest == digest:
+                entry.mtime = stat.st_mtime_ns  # Touched but not modified
+                continue
+
+            self.logger.debug(f'Parsing {filepath} ...')
+            document = self.parser(filepath)
+
+            if entry:
+                folder = entry.document.parent
+                folder.children[folder.children.index(entry.document)] = document
+                document.parent = folder
+                folder.invalidate()
+                changes.changed.append(filepath)
+            else:
+                self.insert(self.folder(filepath.parent), document)
+                changes.added.append(filepath)
+
+            self.manifest[filepath] = Entry(stat.st_size, stat.st_mtime_ns, digest, document)
+
+        for filepath in [p for p in self.manifest if p not in seen]:
+            self.remove(self.manifest.pop(filepath).document)
+            changes.removed.append(filepath)
+
+        return changes
+
+    def watch(self, interval: float = 1.0, callback: Callable[[Changes], None] = None, stop: Event = None) -> None:
+        # Poll for changes until stop is set, run it in a thread to keep the corpus current
+        stop = stop or Event()
+
+        while not stop.is_set():
+            changes = self.refresh()
+            if changes and callback:
+                callback(changes)
+
+            stop.wait(interval)
+
+    def document(self, filepath: Path) -> Document | None:
+        entry = self.manifest.get(Path(filepath))
+        return entry.document if entry else None
+
+    def folder(self, path: Path) -> Folder:
+        folder = self.folders.get(path)
+
+        if folder is None:
+            folder = Folder(path)
+            self.insert(self.folder(path.parent), folder)
+            self.folders[path] = folder
+
+        return folder
+
+    def insert(self, folder: Folder, node: Node) -> None:
+        # Keep children ordered by path
+        key = node_path(node)
+        index = 0
+        while index < len(folder.children) and node_path(folder.children[index]) < key:
+            index += 1
+
+        node.parent = folder
+        folder.children.insert(index, node)
+        folder.invalidate()
+
+    def remove(self, node: Node) -> None:
+        folder = node.parent
+        folder.children.remove(node)
+        folder.invalidate()
+        node.parent = None
+
+        # Drop folders that became empty
+        if folder is not self and not folder.children:
+            del self.folders[folder.path]
+            self.remove(folder)
+
+
+def node_path(node: Node) -> Path:
+    return node.path if isinstance(node, Folder) else node.filepath
@@ -1,8 +1,131 @@
+from functools import lru_cache
+from itertools import islice
+import re
+import sys
+
+
+@lru_cache(maxsize=256)
+def compile_class(chars: str | bytes, negate: bool = False) -> re.Pattern:
+    # Pattern matching a run of characters of (or not of) a character class
+    escaped = re.escape(chars)
+    if isinstance(chars, bytes):
+        return re.compile(b'[^' + escaped + b']*' if negate else b'[' + escaped + b']*')
+    return re.compile(f'[^{escaped}]*' if negate else f'[{escaped}]*')
+
+
+def class_key(buffer, el) -> str | bytes | None:
+    # Character class for str and bytes buffers, None if the buffer type has no native scan
+    if isinstance(buffer, str):
+        if isinstance(el, str):
+            return el
+        if all(isinstance(c, str) and len(c) == 1 for c in el):
+            return ''.join(el)
+    elif isinstance(buffer, (bytes, bytearray)):
+        if isinstance(el, int):
+            return bytes([el])
+        if isinstance(el, (bytes, bytearray)):
+            return bytes(el)
+        if all(isinstance(c, int) for c in el):
+            return bytes(el)
+    return None
+
+
+class Window:
+    # List-like window over an iterable or the bytes of a readable with absolute indices,
+    # items before the released position are dropped apart from a short history
+    def __init__(self, iterable = None, history: int = 64, batch: int = 1024, readable = None):
+        if readable is not None:
+            self.read = readable.read
+            self.items: bytearray | list = bytearray()
+        else:
+            source = iter(iterable)
+            self.read = lambda size: islice(source, size)
+            self.items: bytearray | list = []
+
+        self.base: int = 0  # Index of the first kept item
+        self.history: int = history
+        self.batch: int = batch
+        self.length: int | None = None  # Known once the iterable is exhausted
+        self.iterators: list[Iterator] = []
+
+    def __len__(self) -> int:
+        return sys.maxsize if self.length is None else self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.start is not None and index.start < self.base:
+                raise IndexError(f'Item {index.start} was released')
+            start = max(index.start or 0, self.base)
+            stop = self.base + len(self.items) if index.stop is None else index.stop
+            self.fill(stop)
+            return self.items[start - self.base:max(stop - self.base, 0)]
+
+        i = index - self.base
+        if 0 <= i < len(self.items) - 1:
+            return self.items[i]
+
+        if i < 0:
+            raise IndexError(f'Item {index} was released')
+
+        if not self.fill(index + 1) and index >= self.length:
+            return None
+        return self.items[i]
+
+    def fill(self, index: int) -> bool:
+        # Load items up to index, the end is set on the iterators as soon as it is reached
+        missing = index + 1 - self.base - len(self.items)
+        if missing <= 0:
+            return True
+        if self.length is not None:
+            return False
+
+        # Readables may return less than requested before their end
+        while missing > 0:
+            size = len(self.items)
+            self.items.extend(self.read(max(missing, self.batch)) or b'')
+            if len(self.items) == size:
+                self.length = self.base + size
+                for iterator in self.iterators:
+                    iterator.end = min(iterator.end, self.length)
+                return False
+            missing -= len(self.items) - size
+        return True
+
+    def release(self, index: int) -> None:
+        # Drop items before index except the history, in bulk to keep it amortized
+        drop = index - self.history - self.base
+        if drop <= 0 or drop < len(self.items) // 2:
+            return
+
+        # Items that were never loaded are read and dropped batch by batch
+        while drop > len(self.items):
+            drop -= len(self.items)
+            self.base += len(self.items)
+            self.items.clear()
+            if not self.fill(self.base + min(drop, self.batch) - 1):
+                break
+
+        drop = min(drop, len(self.items))
+        del self.items[:drop]
+        self.base += drop
+
+    def exhaust(self) -> int:
+        # Read to the end keeping only the history, returns the length
+        while self.fill(self.base + len(self.items) + self.batch - 1):
+            self.release(self.base + len(self.items))
+        return self.length
+
+
 class Iterator:
-    def __init__(self, iterable: list):
-        self.buffer : list = iterable
+    def __init__(self, iterable: list | Window):
+        self.buffer : list | Window = iterable
         self.pos : int = 0
         self.beg : int = 0
+
+        # The end of a window is only known once it is reached
+        if isinstance(iterable, Window):
+            iterable.iterators.append(self)
+
         self.end : int = len(self.buffer)
 
         if self.end > 0:
@@ -35,11 +158,20 @@ class Iterator:
 
         return self.get()
 
+    def mark(self) -> int:
+        return self.pos
+
+    def reset(self, mark: int) -> None:
+        self.pos = mark
+        self.get()
+
+    def jump(self, pos: int) -> None:
+        self.pos = pos
+        self.get()
+
     def advance(self, distance: int) -> list:
-        els : list = [None] * distance
-        for i in range(distance):
-            els[i] = self.get()
-            self.next()
+        els = self.buffer[self.pos:self.pos + distance]
+        self.jump(self.pos + distance)
         return els
 
     def peek(self, distance: int = 1) -> list | None:
@@ -60,17 +192,55 @@ class Iterator:
         return False
 
     def consume_until(self, el):
-        while self and self.buffer[self.pos] != el:
-            self.next()
+        buffer, pos, end = self.buffer, self.pos, self.end
+        if pos >= end:
+            return
+
+        if isinstance(buffer, list):
+            try:
+                pos = buffer.index(el, pos, end)
+            except ValueError:
+                pos = end
+        elif isinstance(buffer, (str, bytes, bytearray)) and (isinstance(el, int) or len(el) == 1):
+            pos = buffer.find(el, pos, end)
+            if pos < 0:
+                pos = end
+        else:
+            while pos < self.end and buffer[pos] != el:
+                pos += 1
+
+        self.jump(pos)
 
     def consume_until_any(self, el : list):
-        while self and self.buffer[self.pos] not in el:
-            self.next()
+        self.scan(el, negate=True)
 
     def consume_while(self, el):
-        while self and self.buffer[self.pos] == el:
-            self.next()
+        buffer, pos, end = self.buffer, self.pos, self.end
+        if pos >= end:
+            return
+
+        if isinstance(buffer, (str, bytes, bytearray)) and (isinstance(el, int) or len(el) == 1):
+            self.scan(el)
+            return
+
+        while pos < self.end and buffer[pos] == el:
+            pos += 1
+
+        self.jump(pos)
 
     def consume_while_any(self, el : list):
-        while self and self.buffer[self.pos] in el:
-            self.next()
+        self.scan(el)
+
+    def scan(self, el : list, negate: bool = False):
+        buffer, pos, end = self.buffer, self.pos, self.end
+        if pos >= end:
+            return
+
+        key = class_key(buffer, el)
+        if key:
+            pos = compile_class(key, negate).match(buffer, pos, end).end()
+        else:
+            while pos < self.end and (buffer[pos] in el) != negate:
+                pos += 1
+
+        self.jump(pos)
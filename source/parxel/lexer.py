@@ -1,8 +1,20 @@
+from concurrent.futures import ProcessPoolExecutor
 from io import FileIO, StringIO
+from mmap import mmap, ACCESS_READ
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
-from .token import Token, TK
+from typing import Generator, Iterable, TextIO
+import re
+import sys
+from .budget import Budget
+from .token import Token, TK, TextInterner, TokenRegistry, default_registry, compile_operators, normalize_operators
 from .iterator import Iterator
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def is_alpha(c: str) -> bool:
     if c:
@@ -18,12 +30,42 @@ def is_alpha_numeric(c: str) -> bool:
     return is_alpha(c) or is_numeric(c)
 
 
+def location(text: str, pos: int) -> tuple[int, int]:
+    # Row and column the lexer reports for the character at pos
+    return text.count(TK.LineFeed, 1, pos + 1), pos - max(text.rfind(TK.LineFeed, 1, pos + 1), 0)
+
+
+def rebase(tokens: list[Token], offset: int, row: int, col: int) -> list[Token]:
+    # Move tokens lexed from a slice starting at offset, with the given location, into the full text
+    for token in tokens:
+        token.beg += offset
+        token.end += offset
+        if token.row == 0:
+            token.col += col
+        token.row += row
+    return tokens
+
+
+NUMERIC = '0123456789'
+ALPHA_NUMERIC = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_' + NUMERIC
+
+
 class Lexer(Iterator):
     class EmptyStreamException(Exception):
         def __init__(self, *args):
             super().__init__(*args)
 
-    def __init__(self, filename: str = None, filepath: Path = None, file: FileIO = None, stream: StringIO = None):
+    def __init__(self,
+        filename: str = None,
+        filepath: Path = None,
+        file: FileIO = None,
+        stream: StringIO = None,
+        registry: TokenRegistry = None,
+        operators: list[str] | dict[str, int] = None,
+        interner: TextInterner | bool = None,
+        coalesce: bool | list[str] = None,
+        spans: list[tuple[int, int, int]] = None,
+        vectorized: bool = False):
 
         if filename:
             filepath = Path(filename)
@@ -49,6 +91,29 @@ class Lexer(Iterator):
         self.tbeg : int = 0
         self.tend : int = 0
 
+        # Token types of the grammar
+        self.registry : TokenRegistry = registry or default_registry
+        self.types : dict[str, int] = self.registry.types
+
+        # Multi-character operators and keywords, matched longest first
+        self.operators : dict = self.registry.operators
+        if operators:
+            self.operators = compile_operators(normalize_operators(operators))
+
+        # Share identical token texts, single characters are already shared by the interpreter
+        self.interner : TextInterner | None = TextInterner() if interner is True else interner or None
+
+        # Whitespace kinds whose runs are collapsed into a single token
+        self.coalesce : str = self.registry.coalesce
+        if coalesce is not None:
+            self.coalesce = ''.join(self.registry.whitespaces) if coalesce is True else ''.join(coalesce or [])
+
+        # Sorted source ranges (beg, end, type) recognized by the grammar, emitted as single tokens
+        self.spans : list[tuple[int, int, int]] = spans or []
+
+        # Find token boundaries with NumPy where the grammar allows it
+        self.vectorized : bool = vectorized
+
     def next(self) -> str:
         c = super().next()
 
@@ -60,33 +125,111 @@ class Lexer(Iterator):
 
         return c
 
+    def prev(self) -> str:
+        if self.pos > 0:
+            self.jump(self.pos - 1)
+
+        return self.get()
+
+    def jump(self, pos: int) -> None:
+        # Row and column only depend on the position, as if moved there by next()
+        buffer = self.buffer
+        if pos >= self.pos:
+            lines = buffer.count(TK.LineFeed, self.pos + 1, pos + 1)
+            if lines:
+                self.row += lines
+                self.col = pos - buffer.rfind(TK.LineFeed, self.pos + 1, pos + 1)
+            else:
+                self.col += pos - self.pos
+        else:
+            lines = buffer.count(TK.LineFeed, pos + 1, self.pos + 1)
+            if lines:
+                self.row -= lines
+                self.col = pos - max(buffer.rfind(TK.LineFeed, 1, pos + 1), 0)
+            else:
+                self.col -= self.pos - pos
+
+        super().jump(pos)
+
+    def mark(self) -> tuple[int, int, int, int]:
+        return self.pos, self.row, self.col, self.tend
+
+    def reset(self, mark: tuple[int, int, int, int]) -> None:
+        self.pos, self.row, self.col, self.tend = mark
+        self.get()
+
     def make_token(self, type: int) -> Token:
         self.tbeg = self.tend  # End of last token
         self.tend = self.pos + 1  # End of current token
-        text = self.buffer[self.tbeg:self.tend] if self.tend - self.tbeg > 1 else self.buffer[self.pos]
+        if self.tend - self.tbeg > 1:
+            text = self.buffer[self.tbeg:self.tend]
+            if self.interner:
+                text = self.interner(text)
+        else:
+            text = self.buffer[self.pos]
         return Token(self.tbeg, self.tend, self.row, self.col, type, text)
 
-    def tokenize(self) -> list[Token]:
+    def match_operator(self) -> tuple[int, int]:
+        node = self.operators
+        length, type = 0, TK.Undefined
+        i = self.pos
+
+        while i < self.end and (node := node.get(self.buffer[i])):
+            i += 1
+            if None in node:
+                # Operators ending in a word character must not be followed by another one
+                if not (is_alpha_numeric(self.buffer[i - 1]) and i < self.end and is_alpha_numeric(self.buffer[i])):
+                    length, type = i - self.pos, node[None]
+
+        return length, type
+
+    def tokenize(self, budget: Budget = None) -> list[Token]:
+        # Operators and spans need the character loop
+        if self.vectorized and numpy is not None and isinstance(self.buffer, str):
+            if not self.operators and not self.spans:
+                return self.tokenize_vectorized(budget)
+
         c : str = self.get()
 
+        spans = iter(self.spans)
+        span = next(spans, None)
+
+        # Position of the next budget check
+        check = budget.interval if budget else sys.maxsize
+
         while self and c:
 
-            if c in TK.Whitespaces:
-                self.tokens.append(self.make_token(TK[c]))
+            if self.pos >= check:
+                budget.check(tokens=len(self.tokens), partial=self.tokens)
+                check = self.pos + budget.interval
+
+            if span and self.pos == span[0]:
+                self.jump(span[1] - 1)
+
+                self.tokens.append(self.make_token(span[2]))
+                span = next(spans, None)
+
+            elif c in self.operators and (match := self.match_operator())[0]:
+                length, type = match
+                self.jump(self.pos + length - 1)
+
+                self.tokens.append(self.make_token(type))
 
-            elif c in TK.Symbols:
-                self.tokens.append(self.make_token(TK[c]))
+            elif c in self.types:
+                if c in self.coalesce:
+                    self.consume_while(c)
+                    self.prev()
+
+                self.tokens.append(self.make_token(self.types[c]))
 
             elif is_numeric(c):
-                while is_numeric(c):
-                    c = self.next()
+                self.consume_while_any(NUMERIC)
                 self.prev()
 
                 self.tokens.append(self.make_token(TK.Number))
 
             elif is_alpha(c):
-                while is_alpha_numeric(c):
-                    c = self.next()
+                self.consume_while_any(ALPHA_NUMERIC)
                 self.prev()
                 
                 self.tokens.append(self.make_token(TK.Word))
@@ -97,3 +240,230 @@ class Lexer(Iterator):
             c = self.next()
 
         return self.tokens
+
+    def tokenize_vectorized(self, budget: Budget = None) -> list[Token]:
+        text = self.buffer
+        begs, ends, rows, cols, types = scan(text, self.types, self.coalesce)
+
+        if budget:
+            budget.check(tokens=len(self.tokens) + len(begs), partial=self.tokens)
+
+        interner = self.interner
+        for beg, end, row, col, type in zip(begs.tolist(), ends.tolist(), rows.tolist(), cols.tolist(), types.tolist()):
+            token_text = text[beg:end]
+            if interner and end - beg > 1:
+                token_text = interner(token_text)
+            self.tokens.append(Token(beg, end, row, col, type, token_text))
+
+        self.pos = self.end
+        return self.tokens
+
+
+# Character classes of the vectorized lexer
+OTHER, SINGLE, COALESCED, DIGIT, ALPHA = range(5)
+
+
+def scan(text: str, types: dict[str, int], coalesce: str) -> tuple:
+    # Columnar tokens (beg, end, row, col, type) of a text as NumPy arrays, the same as Lexer.tokenize
+    # without operators and spans
+    n = len(text)
+    if not n:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, empty, empty, numpy.zeros(0, dtype=object)
+
+    codes = numpy.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+
+    # Lookup tables indexed by code point, code points past the tables are symbols
+    size = max([128] + [ord(c) + 1 for c in types]) + 1
+    classes = numpy.full(size, OTHER, dtype=numpy.uint8)
+    table = numpy.full(size, TK.Symbol, dtype=object)
+    for c in NUMERIC:
+        classes[ord(c)], table[ord(c)] = DIGIT, TK.Number
+    for c in ALPHA_NUMERIC[:-len(NUMERIC)]:
+        classes[ord(c)], table[ord(c)] = ALPHA, TK.Word
+    for c, type in types.items():
+        classes[ord(c)], table[ord(c)] = COALESCED if c in coalesce else SINGLE, type
+
+    codes = numpy.minimum(codes, size - 1)
+    kind = classes[codes]
+    prev, cur = kind[:-1], kind[1:]
+
+    starts = numpy.ones(n, dtype=bool)
+    starts[1:] = (cur <= SINGLE) \
+        | ((cur == COALESCED) & (codes[1:] != codes[:-1])) \
+        | ((cur >= DIGIT) & (prev < DIGIT))
+
+    # Alphanumeric runs are a number of leading digits followed by a word
+    letters = numpy.flatnonzero((cur == ALPHA) & (prev == DIGIT)) + 1
+    if len(letters):
+        others = numpy.flatnonzero(kind != DIGIT)
+        before = numpy.searchsorted(others, letters - 1) - 1  # Last character before the digits
+        starts[letters] = (before < 0) | (kind[others[numpy.maximum(before, 0)]] < DIGIT)
+
+    begs = numpy.flatnonzero(starts)
+    ends = numpy.append(begs[1:], n)
+
+    # Location of the last character of each token, see location
+    last = ends - 1
+    linefeeds = codes == ord(TK.LineFeed)
+    linefeeds[0] = False
+    rows = numpy.cumsum(linefeeds, dtype=numpy.uint32)[last]
+    lines = numpy.concatenate(([0], numpy.flatnonzero(linefeeds)))
+    cols = last - lines[rows]
+
+    return begs, ends, rows, cols, table[codes[begs]]
+
+
+def tokenize_parallel(
+    filepath: Path = None,
+    stream: str = None,
+    workers: int = None,
+    chunk_size: int = 1 << 24,
+    encoding: str = 'utf-8',
+    **options) -> list[Token]:
+
+    # Tokenize chunks split at the start of whitespace runs in a process pool, the input is
+    # memory mapped or put into shared memory and read by the workers
+    interner = options.pop('interner', None)
+    interner = TextInterner() if interner is True else interner
+
+    whitespaces = boundaries(options)
+    if not whitespaces:
+        chunk_size = sys.maxsize
+
+    size = Path(filepath).stat().st_size if filepath else len(stream or '')
+    if size <= chunk_size or workers == 1:
+        return Lexer(filepath=filepath and Path(filepath), stream=stream, interner=interner, **options).tokenize()
+
+    if filepath:
+        file = Path(filepath).open('rb')
+        source, shared = str(filepath), None
+        buffer = mmap(file.fileno(), 0, access=ACCESS_READ)
+    else:
+        file = None
+        data = stream.encode(encoding)
+        shared = SharedMemory(create=True, size=len(data))
+        shared.buf[:len(data)] = data
+        source, buffer = shared.name, shared.buf
+    size = len(buffer)
+
+    try:
+        # Chunk boundaries and the position of each chunk in the decoded text
+        ws = re.escape(whitespaces.encode(encoding))
+        boundary = re.compile(b'(?<![' + ws + b'\r])[' + ws + b']')
+        offsets = [0]
+        while (match := boundary.search(buffer, offsets[-1] + chunk_size)) is not None:
+            offsets.append(match.start())
+
+        ranges = list(zip(offsets, offsets[1:] + [size]))
+        texts = (decode(buffer[beg:end], encoding, shared is None) for beg, end in ranges)
+        chunks = [(source, shared is not None, beg, end, offset, row, col, encoding, options)
+                  for (beg, end), (_, offset, row, col) in zip(ranges, locate_chunks(texts))]
+
+        tokens = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chunk in executor.map(tokenize_chunk, *zip(*chunks)):
+                tokens.extend(chunk)
+
+        if interner:
+            for token in tokens:
+                if len(token.text) > 1:
+                    token.text = interner(token.text)
+
+        return tokens
+    finally:
+        if file:
+            buffer.close()
+            file.close()
+        if shared:
+            del buffer
+            shared.close()
+            shared.unlink()
+
+
+def tokenize_blocks(file: TextIO, block_size: int = 1 << 16, **options) -> Generator[Token, None, None]:
+    # Tokenize a text file lazily, blocks are cut at the start of the last whitespace run
+    whitespaces = boundaries(options)
+    if not whitespaces:
+        block_size = -1  # Read everything
+
+    if options.get('interner') is True:
+        options['interner'] = TextInterner()
+
+    def blocks():
+        rest = ''
+        while block := file.read(block_size):
+            text = rest + block
+            cut = len(text) - 1
+            while cut > 0 and not (text[cut] in whitespaces and text[cut - 1] not in whitespaces):
+                cut -= 1
+
+            if cut > 0:
+                yield text[:cut]
+                rest = text[cut:]
+            else:
+                rest = text
+        if rest:
+            yield rest
+
+    for text, offset, row, col in locate_chunks(blocks()):
+        yield from rebase(Lexer(stream=text, **options).tokenize(), offset, row, col)
+
+
+def locate_chunks(texts: Iterable[str]) -> Generator[tuple[str, int, int, int], None, None]:
+    # Offset, row and column of consecutive chunks of a text, see location
+    offset = rows = last = 0
+    for text in texts:
+        if offset and text[0] == TK.LineFeed:
+            yield text, offset, rows + 1, 0
+        else:
+            yield text, offset, rows, offset - last
+
+        rows += text.count(TK.LineFeed, 0 if offset else 1)
+        if (i := text.rfind(TK.LineFeed)) > 0 or i == 0 and offset:
+            last = offset + i
+        offset += len(text)
+
+
+def tokenize_chunk(source: str, shared: bool, beg: int, end: int, offset: int, row: int, col: int, encoding: str,
+                   options: dict) -> list[Token]:
+    if shared:
+        memory = SharedMemory(name=source)
+        try:
+            text = decode(memory.buf[beg:end], encoding, False)
+        finally:
+            memory.close()
+    else:
+        with open(source, 'rb') as file, mmap(file.fileno(), 0, access=ACCESS_READ) as buffer:
+            text = decode(buffer[beg:end], encoding, True)
+
+    return rebase(Lexer(stream=text, **options).tokenize(), offset, row, col)
+
+
+def decode(data, encoding: str, newlines: bool) -> str:
+    text = bytes(data).decode(encoding)
+    if newlines:
+        # Universal newlines like files opened in text mode
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+def boundaries(options: dict) -> str:
+    # Whitespace that starts a token in the grammar given by the lexer options, nothing if operators may span it
+    registry = options.get('registry') or default_registry
+    whitespaces = ''.join(registry.whitespaces)
+
+    operators = options.get('operators')
+    operators = compile_operators(normalize_operators(operators)) if operators else registry.operators
+    if any(c in whitespaces for c in operator_chars(operators)):
+        return ''
+    return whitespaces
+
+
+def operator_chars(operators: dict) -> set[str]:
+    chars = set()
+    for key, node in operators.items():
+        if key is not None:
+            chars.add(key)
+            chars |= operator_chars(node)
+    return chars
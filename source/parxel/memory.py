@@ -0,0 +1,146 @@
+from collections import deque
+from gc import get_referents
+from io import IOBase
+from logging import Logger
+from sys import getsizeof
+from types import BuiltinFunctionType, FunctionType, MethodType, ModuleType
+
+
+SCALARS = (int, float, complex, bool, type(None))
+STRINGS = (str, bytes, bytearray)
+SEQUENCES = (list, tuple, deque)
+CONTAINERS = SEQUENCES + (set, frozenset, dict)
+
+# Objects that are measured but not followed
+OPAQUE = (type, ModuleType, FunctionType, MethodType, BuiltinFunctionType, Logger, IOBase)
+
+
+class Footprint:
+    def __init__(self):
+        self.nodes: dict[str, int] = {}  # Bytes by node type, the node objects and their scalar attributes
+        self.tokens: int = 0  # Token objects and their positions
+        self.strings: int = 0  # Texts of tokens and nodes and sources
+        self.containers: int = 0  # Lists, dicts and the like, without their items
+        self.other: int = 0
+        self.objects: int = 0
+
+    def __repr__(self):
+        return f'Footprint(total={self.total}, nodes={sum(self.nodes.values())}, tokens={self.tokens}, ' \
+               f'strings={self.strings}, containers={self.containers}, other={self.other})'
+
+    @property
+    def total(self) -> int:
+        return sum(self.nodes.values()) + self.tokens + self.strings + self.containers + self.other
+
+    def add(self, owner: str | None, size: int) -> None:
+        if owner is None:
+            self.other += size
+        elif owner == 'tokens':
+            self.tokens += size
+        else:
+            self.nodes[owner] = self.nodes.get(owner, 0) + size
+
+    def report(self) -> dict:
+        return {
+            'total': self.total,
+            'nodes': dict(sorted(self.nodes.items(), key=lambda x: -x[1])),
+            'tokens': self.tokens,
+            'strings': self.strings,
+            'containers': self.containers,
+            'other': self.other,
+            'objects': self.objects
+        }
+
+    def dump(self) -> str:
+        report = self.report()
+        s = ''
+        for k, v in report.items():
+            if k == 'nodes':
+                s += f'{k:20s} {sum(v.values()):12d}\n'
+                for name, size in v.items():
+                    s += f' {name:19s} {size:12d}\n'
+            else:
+                s += f'{k:20s} {v:12d}\n'
+        return s
+
+
+def footprint(*objects, sample: int = 1) -> Footprint:
+    # Deep size of trees, token lists and parsers, objects reachable more than once are counted once.
+    # References are followed without touching __dict__, which would build a dict for every object.
+    # With sample n only the tokens of every n-th block of source are measured and counted n times,
+    # tokens shared by nodes and parser buffers are measured everywhere or nowhere.
+    result = Footprint()
+    kinds: dict[type, str] = {}
+
+    # Trees are not followed upwards from the given nodes
+    seen: set[int] = {id(getattr(obj, 'parent', None)) for obj in objects}
+    stack: list[tuple[object, int, str | None]] = [(obj, 1, None) for obj in objects]
+
+    while stack:
+        obj, weight, owner = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+
+        cls = type(obj)
+        kind = kinds.get(cls) or kinds.setdefault(cls, classify(cls))
+
+        if kind == 'tokens' and sample > 1:
+            # Runs of tokens from the same 4 KiB of source share their positions and texts
+            if (obj.beg >> 12) % sample:
+                continue
+            weight = sample
+
+        size = getsizeof(obj)
+        result.objects += 1
+
+        # Small integers and single characters are shared by the interpreter
+        if kind == 'string':
+            if not (cls is str and (not obj or len(obj) == 1 and ord(obj) < 256)):
+                result.strings += size * weight
+            continue
+        if kind == 'scalar':
+            if not (cls is int and -5 <= obj <= 256 or obj is None or cls is bool):
+                result.add(owner, size * weight)
+            continue
+        if kind == 'opaque':
+            result.add(owner, size * weight)
+            continue
+
+        referents = get_referents(obj)
+
+        if kind == 'container':
+            result.containers += size * weight
+        else:
+            if kind == 'tokens':
+                owner = kind
+            elif kind == 'node':
+                owner = cls.__name__
+
+            # Attribute values stored with the object instead of in a dict
+            if cls.__dictoffset__:
+                size += 8 * (len(referents) - 1)
+            result.add(owner, size * weight)
+
+        for referent in referents:
+            if referent is not cls:
+                stack.append((referent, weight, owner))
+
+    return result
+
+
+def classify(cls: type) -> str:
+    # Nodes and tokens by their interface, the library may be imported under more than one name
+    if issubclass(cls, STRINGS):
+        return 'string'
+    if issubclass(cls, CONTAINERS):
+        return 'container'
+    if issubclass(cls, SCALARS):
+        return 'scalar'
+    if issubclass(cls, OPAQUE):
+        return 'opaque'
+    if hasattr(cls, 'walk') and hasattr(cls, 'enter_scope'):
+        return 'node'
+    if cls.__name__ == 'Token' and hasattr(cls, 'length'):
+        return 'tokens'
+    return 'other'
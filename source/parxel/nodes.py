@@ -1,12 +1,19 @@
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
 from hashlib import md5
 from pathlib import Path
+from typing import Callable
 import re
 
 from parxel.token import Token
 
+
 class Node:
     RE_PATH = re.compile(r'(\*|\w+)(?:\[(\w+)\s*(=|!=|in|not in)\s*(.*?)\])?')
 
+    # Event handler of a root node parsed in event mode
+    events = None
+
     def __init__(self, parent = None):
         self.parent: Node = parent
         self.children: list[Node] = []
@@ -25,27 +32,184 @@ class Node:
         hash_string = ''
         hash_string += self.type()
         hash_string += ''.join(str(arg) for arg in tweak if arg is not None)
+        local = hash_string
         hash_string += str(len(self.children))
-        hash_string += ''.join(set(map(lambda x : x.type(), self.children)))
+        hash_string += ''.join(sorted(set(map(lambda x : x.type(), self.children))))
 
         for child in self.children:
-            hash_string += child.hash()
-
-        return md5(hash_string.encode('utf-8')).hexdigest()
+            hash_string += child.fingerprint()
+
+        digest = md5(hash_string.encode('utf-8')).hexdigest()
+
+        # Subtree and local hash, kept until the subtree changes through add or invalidate
+        self.digests: tuple[str, str] | None = digest, md5(local.encode('utf-8')).hexdigest()
+
+        return digest
+
+    def fingerprint(self) -> str:
+        digests = getattr(self, 'digests', None)
+        if digests is None:
+            return self.hash()
+        return digests[0]
+
+    def diff(self, other: "Node") -> "NodeDiff":
+        result = NodeDiff()
+        self.diff_subtree(other, result)
+        return result
+
+    def diff_subtree(self, other: "Node", result: "NodeDiff") -> None:
+        # Identical subtrees are skipped without descending into them
+        if self.fingerprint() == other.fingerprint():
+            return
+
+        if self.type() != other.type():
+            result.removed.append(self)
+            result.inserted.append(other)
+            return
+
+        if self.digests[1] != other.digests[1]:
+            result.changed.append((self, other))
+
+        old, new = self.children, other.children
+
+        # Pair identical children
+        identical: dict[str, list[int]] = {}
+        for i, child in enumerate(old):
+            identical.setdefault(child.fingerprint(), []).append(i)
+
+        pairs: list[tuple[int, int]] = []
+        added: list[int] = []
+        for j, child in enumerate(new):
+            candidates = identical.get(child.fingerprint())
+            if candidates:
+                pairs.append((candidates.pop(0), j))
+            else:
+                added.append(j)
+
+        # Identical children outside the longest common order have been moved
+        pairs.sort()
+        kept = longest_increasing([j for _, j in pairs])
+        for k, (i, j) in enumerate(pairs):
+            if k not in kept:
+                result.moved.append((old[i], new[j]))
+
+        # Descend into remaining children of the same type, in order
+        paired = {i for i, _ in pairs}
+        unpaired: dict[str, list[int]] = {}
+        for i, child in enumerate(old):
+            if i not in paired:
+                unpaired.setdefault(child.type(), []).append(i)
+
+        for j in added:
+            candidates = unpaired.get(new[j].type())
+            if candidates:
+                old[candidates.pop(0)].diff_subtree(new[j], result)
+            else:
+                result.inserted.append(new[j])
+
+        for candidates in unpaired.values():
+            result.removed.extend(old[i] for i in candidates)
 
     def add(self, other) -> None:
         other.parent = self
         self.children.append(other)
 
+        if getattr(self, 'span_index', None) is not None or getattr(self, 'digests', None) is not None:
+            self.invalidate()
+
+    def span(self) -> tuple[int, int] | None:
+        # Source range of the children
+        begs, ends, reach, children = self.spans()
+        return (begs[0], reach[-1]) if begs else None
+
+    def spans(self) -> tuple[list[int], list[int], list[int], list["Node"]]:
+        # Children with a source range sorted by start, with the running maximum of their ends.
+        # Built on first use, nodes that change children directly instead of through add have to
+        # invalidate it.
+        index = getattr(self, 'span_index', None)
+        if index is None:
+            entries = []
+            for child in self.children:
+                span = child.span()
+                if span and span[0] < span[1]:
+                    entries.append((span[0], span[1], child))
+            entries.sort(key=lambda x: x[0])
+
+            begs, ends, reach = [], [], []
+            for beg, end, _ in entries:
+                begs.append(beg)
+                ends.append(end)
+                reach.append(max(end, reach[-1]) if reach else end)
+
+            index = self.span_index = begs, ends, reach, [child for _, _, child in entries]
+        return index
+
+    def invalidate(self) -> None:
+        # Drop the span indices and hashes of this node and its ancestors
+        node = self
+        while node is not None:
+            node.span_index = None
+            node.digests = None
+            node = node.parent
+
+    def node_at(self, offset: int) -> "Node | None":
+        # Innermost descendant whose source range contains offset
+        found, node = None, self
+        while True:
+            begs, ends, reach, children = node.spans()
+            i = bisect_right(begs, offset) - 1
+            while i >= 0 and ends[i] <= offset < reach[i]:
+                i -= 1
+            if i < 0 or ends[i] <= offset:
+                return found
+
+            # The extent of a placeholder only bounds the span of its node
+            if 'builder' in children[i].__dict__:
+                children[i].expand()
+                continue
+            found = node = children[i]
+
+    def nodes_in_range(self, beg: int, end: int) -> list["Node"]:
+        # Descendants whose source range intersects [beg, end), in document order
+        nodes = []
+        begs, ends, reach, children = self.spans()
+        i = bisect_right(reach, beg)
+        while i < len(begs) and begs[i] < end:
+            if ends[i] > beg:
+                if 'builder' in children[i].__dict__:
+                    children[i].expand()
+                    return self.nodes_in_range(beg, end)
+                nodes.append(children[i])
+                nodes.extend(children[i].nodes_in_range(beg, end))
+            i += 1
+        return nodes
+
     def enter_scope(self, other) -> None:
-        self.scope.add(other)
+        if self.events:
+            self.attach(other)
+            self.events.enter(other)
+        else:
+            self.scope.add(other)
         self.scope = other
 
     def exit_scope(self) -> None:
+        if self.events:
+            self.events.leave(self.scope)
         self.scope = self.scope.parent
 
     def add_to_scope(self, other) -> None:
-        self.scope.add(other)
+        if self.events:
+            self.attach(other)
+            self.events.leaf(other)
+        else:
+            self.scope.add(other)
+
+    def attach(self, other) -> None:
+        # In event mode top level nodes are passed to the handler instead of being kept
+        if self.scope is self:
+            other.parent = self
+        else:
+            self.scope.add(other)
 
     def find(self, node_type):
         for child in self.children:
@@ -150,6 +314,157 @@ class Node:
         for child in self.children:
             yield from child.walk()
 
+    def walk_built(self):
+        # Like walk, without building or visiting the placeholders of deferred nodes
+        yield self
+
+        for child in self.children:
+            if 'builder' not in child.__dict__:
+                yield from child.walk_built()
+
+
+class Deferred:
+    # Placeholder of a node that is only built on first access of its children or attributes,
+    # the placeholder then turns into the node in place
+
+    @property
+    def children(self) -> list[Node]:
+        return self.expand().children
+
+    def __getattr__(self, name: str):
+        if name.startswith('__') or 'builder' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.expand(), name)
+
+    def __reduce_ex__(self, protocol):
+        return self.expand().__reduce_ex__(protocol)
+
+    def hash(self, *tweak: str):
+        # Placeholders with a key for their content are hashed without building them, independent
+        # of where they are in the source
+        if 'builder' in self.__dict__ and self.key is not None:
+            hash_string = self.type() + self.key
+            digest = md5(hash_string.encode('utf-8')).hexdigest()
+            self.digests = digest, digest
+            return digest
+        return super().hash(*tweak)
+
+    def span(self) -> tuple[int, int] | None:
+        # The bounds given to defer, if any, without building the node
+        if 'builder' in self.__dict__ and self.__dict__.get('extent'):
+            return self.__dict__['extent']
+        return self.expand().span()
+
+    def expand(self) -> Node:
+        node = self.__dict__.pop('builder')()
+        self.__dict__.pop('extent', None)
+        self.__dict__.pop('key', None)
+
+        self.__class__ = node.__class__
+        self.__dict__.update({k: v for k, v in node.__dict__.items() if k != 'parent'})
+        self.scope = self
+        for child in self.children:
+            child.parent = self
+
+        # Neither the hash nor the extent of the placeholder are those of the node
+        self.invalidate()
+
+        return self
+
+
+@lru_cache(maxsize=None)
+def deferred_class(cls: type) -> type:
+    return type(cls.__name__, (Deferred, cls), {'__module__': cls.__module__})
+
+
+def defer(cls: type, builder: Callable[[], Node], parent: Node = None, extent: tuple[int, int] = None,
+          key: str = None) -> Node:
+    # Placeholder for a node of class cls returned by builder, extent bounds its source range if known
+    # and key identifies its content, like its source text
+    node = deferred_class(cls).__new__(deferred_class(cls))
+    node.builder = builder
+    node.extent = extent
+    node.key = key
+    node.parent = None
+    node.scope = node
+    node.digests = None
+    if parent:
+        parent.add(node)
+    return node
+
+
+class NodeDiff:
+    def __init__(self):
+        self.inserted: list[Node] = []  # Subtrees of the other tree
+        self.removed: list[Node] = []  # Subtrees of this tree
+        self.moved: list[tuple[Node, Node]] = []
+        self.changed: list[tuple[Node, Node]] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.inserted or self.removed or self.moved or self.changed)
+
+    def __repr__(self):
+        return f'NodeDiff(inserted={len(self.inserted)}, removed={len(self.removed)}, ' \
+               f'moved={len(self.moved)}, changed={len(self.changed)})'
+
+
+class NodeTable:
+    def __init__(self):
+        self.nodes: dict[str, Node] = {}
+        self.hits: int = 0
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def canonicalize(self, root: Node) -> Node:
+        # Replace subtrees by a structurally identical shared instance, shared subtrees must
+        # not be modified afterwards and keep the parent of their first occurrence
+        self.share(root)
+        return root
+
+    def share(self, node: Node) -> None:
+        for i, child in enumerate(node.children):
+            if isinstance(child, (Folder, Document)):
+                self.share(child)
+                continue
+
+            fingerprint = child.fingerprint()
+            shared = self.nodes.get(fingerprint)
+
+            if shared is None:
+                self.nodes[fingerprint] = child
+
+                # Placeholders are left to be built on access
+                if 'builder' not in child.__dict__:
+                    self.share(child)
+            elif shared is not child:
+                node.children[i] = shared
+                self.hits += 1
+
+
+def longest_increasing(values: list[int]) -> set[int]:
+    # Indices of one longest strictly increasing subsequence
+    tails: list[int] = []
+    tail_indices: list[int] = []
+    previous: list[int] = [-1] * len(values)
+
+    for i, value in enumerate(values):
+        k = bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tail_indices.append(i)
+        else:
+            tails[k] = value
+            tail_indices[k] = i
+        previous[i] = tail_indices[k - 1] if k > 0 else -1
+
+    result = set()
+    i = tail_indices[-1] if tail_indices else -1
+    while i >= 0:
+        result.add(i)
+        i = previous[i]
+    return result
+
 
 class Folder(Node):
     def __init__(self, path: Path, parent: Node = None):
@@ -175,20 +490,77 @@ class LexicalNode(Node):
     def __init__(self, tokens: list[Token], parent: Node = None):
         Node.__init__(self, parent=parent)
 
-        self.tokens: list[Token] = tokens
+        self.tokens: list[Token] | None = tokens
 
     def hash(self, *tweak: str):
         return super().hash(self.raw(), tweak)
 
     def raw(self) -> str:
+        if self.tokens is None:
+            return self.source[self.beg:self.end]
         return ''.join(list(map(lambda x: x.text, self.tokens)))
 
+    def span(self) -> tuple[int, int]:
+        if self.tokens is None:
+            return self.beg, self.end
+        if not self.tokens:
+            return 0, 0
+        return self.tokens[0].beg, self.tokens[-1].end
+
+    def release_tokens(self, source: str | None) -> None:
+        # Keep the span of the tokens in the source instead of the tokens
+        if self.tokens is None:
+            return
+
+        first = self.tokens[0] if self.tokens else Token()
+        self.beg, self.end = self.span()
+        self.source: str | Excerpt = Excerpt(self.raw(), self.beg) if source is None else source
+        self.row: int = first.row
+        self.col: int = first.col
+        self.tokens = None
+
+
+class Excerpt:
+    # Text of a single node in place of a source, for tokens that were not lexed from a whole stream.
+    # Sliced with source offsets like the source would be.
+    __slots__ = ('text', 'base')
+
+    def __init__(self, text: str, base: int):
+        self.text: str = text
+        self.base: int = base
+
+    def __getitem__(self, key: slice) -> str:
+        return self.text[key.start - self.base:key.stop - self.base]
+
 
 class BinaryNode(Node):
-    def __init__(self, blob: bytes, parent: Node = None):
+    def __init__(self, blob: bytes = None, parent: Node = None, buffer: bytes = None, offset: int = 0, length: int = 0):
         Node.__init__(self, parent=parent)
 
-        self.bytes: bytes = blob
+        self.blob: bytes = blob
+
+        # Lazy view into a shared buffer, only read when the bytes are accessed
+        self.buffer: bytes = buffer
+        self.offset: int = offset
+        self.length: int = length if blob is None else len(blob)
+
+    @classmethod
+    def view(cls, buffer: bytes, offset: int, length: int, parent: Node = None):
+        # Subclasses decode their content on access instead of in __init__
+        node = cls.__new__(cls)
+        BinaryNode.__init__(node, parent=parent, buffer=buffer, offset=offset, length=length)
+        return node
+
+    @property
+    def bytes(self) -> bytes:
+        if self.blob is None and self.buffer is not None:
+            return self.buffer[self.offset:self.offset + self.length]
+        return self.blob
+
+    @bytes.setter
+    def bytes(self, blob) -> None:
+        self.blob = blob
+        self.length = 0 if blob is None else len(blob)
 
     def hash(self, *tweak: str):
         return super().hash(self.bytes, tweak)
@@ -1,17 +1,64 @@
+import array
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from io import FileIO, StringIO
+from mmap import mmap, ACCESS_READ
+from os import fstat
 from pathlib import Path
 from logging import Logger, getLogger
 from struct import unpack
 
-from parxel.token import Token, TK
-from parxel.iterator import Iterator
-from parxel.nodes import Node, Document
-from parxel.lexer import Lexer
+from parxel.budget import Budget
+from parxel.token import Token, TK, TextInterner, TokenRegistry, default_registry
+from parxel.iterator import Iterator, Window
+from parxel.nodes import Node, Document, NodeTable, BinaryNode
+from parxel.lexer import Lexer, location, rebase, tokenize_blocks
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 logger = getLogger(__name__)
 
 
+class Event:
+    Enter = 'enter'
+    Leave = 'leave'
+    Leaf = 'leaf'
+
+
+class EventHandler:
+    def enter(self, node: Node) -> None:
+        pass
+
+    def leave(self, node: Node) -> None:
+        pass
+
+    def leaf(self, node: Node) -> None:
+        pass
+
+
+class EventQueue(EventHandler):
+    def __init__(self):
+        self.queue: deque[tuple[str, Node]] = deque()
+
+    def enter(self, node: Node) -> None:
+        self.queue.append((Event.Enter, node))
+
+    def leave(self, node: Node) -> None:
+        self.queue.append((Event.Leave, node))
+
+    def leaf(self, node: Node) -> None:
+        self.queue.append((Event.Leaf, node))
+
+    def drain(self):
+        while self.queue:
+            yield self.queue.popleft()
+
+
 class Parser(Iterator):
     def __init__(self,
         iterable: list = None,
@@ -19,16 +66,18 @@ class Parser(Iterator):
         filename: str = None,
         filepath: Path = None,
         file: FileIO = None,
-        logger: Logger = logger):
+        logger: Logger = logger,
+        node_table: NodeTable = None):
 
         Iterator.__init__(self, iterable=iterable)
 
         self.logger = logger
+        self.node_table = node_table
         self.filename = filename
+        self.filepath: Path = filepath
         self.file = file
 
         if filepath:
-            self.filepath: Path = filepath
             self.root = Document(filepath)
         else:
             self.root = Node()
@@ -40,14 +89,42 @@ class Parser(Iterator):
         self.nbeg: int = 0
         self.nend: int = 0
 
-    def parse(self) -> Node | Document:
+        # Checked every budget interval steps
+        self.budget: Budget | None = None
+        self.steps: int = 0
+        self.nodes: int = 0  # Collected nodes
+
+    def parse(self, budget: Budget = None) -> Node | Document:
         if self.filepath:
             self.logger.debug(f'Processing {self.filepath} ...')
-        return self.parse_format()
+
+        if budget:
+            self.budget = budget
+        if self.budget:
+            self.steps = self.budget.interval
+
+        root = self.parse_format()
+        self.finish(root)
+
+        if self.node_table is not None:
+            self.node_table.canonicalize(root)
+
+        return root
+
+    def finish(self, root: Node) -> None:
+        # Done with parsing, before subtrees are shared with other documents
+        pass
 
     def parse_format(self):
         raise NotImplementedError('Implement the "parse_format" method!')
 
+    def spend(self) -> None:
+        # One step of the parser, the budget is only checked every interval steps
+        self.steps -= 1
+        if self.steps <= 0:
+            self.steps = self.budget.interval
+            self.budget.check(tokens=self.pos, nodes=self.nodes, partial=self.root)
+
     @classmethod
     def read(cls: type, filename: str = None, filepath: Path = None, file: FileIO = None, stream: StringIO = None):
 
@@ -59,13 +136,25 @@ class Parser(Iterator):
 
 
 class BinaryParser(Parser):
+    # Element type: (array typecode, NumPy dtype), integers are read unsigned like int.from_bytes
+    ARRAY_TYPES = {
+        'int16': ('H', 'u2'),
+        'int32': ('I' if array.array('I').itemsize == 4 else 'L', 'u4'),
+        'int64': ('Q', 'u8'),
+        'float32': ('f', 'f4'),
+        'float64': ('d', 'f8')
+    }
+
     def __init__(self,
         buffer: bytes = None,
         root: Node = None,
         filename: str = None,
         filepath: Path = None,
         file: FileIO = None,
-        logger: Logger = logger):
+        logger: Logger = logger,
+        node_table: NodeTable = None,
+        mapped: bool = False,
+        window: int = None):
 
         if filename:
             filepath = Path(filename)
@@ -74,18 +163,99 @@ class BinaryParser(Parser):
             file = filepath.open('rb')
 
         if file:
-            buffer = file.read()
-
-        Parser.__init__(self, iterable=buffer, root=root, filename=filename, filepath=filepath, file=file, logger=logger)
+            # Memory mapped files are only read where the parser looks
+            if mapped and fstat(file.fileno()).st_size > 0:
+                buffer = mmap(file.fileno(), 0, access=ACCESS_READ)
+            # Any readable, including pipes and sockets, is read into a window of the last bytes
+            elif window:
+                buffer = Window(readable=file, history=window, batch=min(window, 1 << 16))
+            else:
+                buffer = file.read()
+
+        Parser.__init__(self, iterable=buffer, root=root, filename=filename, filepath=filepath, file=file, logger=logger,
+                        node_table=node_table)
+
+    def section(self, offset: int, length: int, root: Node = None) -> "BinaryParser":
+        # Parser over a window of the same buffer, positions are relative to the window
+        parser = BinaryParser(buffer=self.buffer, root=root, logger=self.logger)
+        parser.beg = parser.pos = parser.nend = min(self.beg + offset, self.end)
+        parser.end = min(parser.beg + length, self.end)
+        parser.get()
+        return parser
+
+    def tell(self) -> int:
+        return self.pos - self.beg
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        # Windows can only seek forward or within their history, their end is known once it is read
+        if whence == 1:
+            offset += self.pos - self.beg
+        elif whence == 2:
+            if isinstance(self.buffer, Window):
+                self.buffer.exhaust()
+            offset += self.end - self.beg
+
+        self.pos = self.nend = self.beg + max(offset, 0)
+        self.release()
+        self.get()
+
+        if self.budget:
+            self.spend()
+        return self.tell()
+
+    def skip(self, distance: int) -> int:
+        # Like advance without reading, skipped bytes belong to the current node
+        self.pos += distance
+        self.release()
+        self.get()
+
+        if self.budget:
+            self.spend()
+        return self.tell()
+
+    def release(self) -> None:
+        # Bytes further back than the window can not be collected anymore
+        if isinstance(self.buffer, Window):
+            self.buffer.release(self.pos)
 
     def advance(self, distance: int) -> bytearray:
-        els : bytearray = bytearray(distance)
-        for i in range(distance):
-            els[i] = self.get() or 0
-            self.next()
+        beg = self.pos
+        end = max(min(beg + distance, self.end), beg)
+        els : bytearray = bytearray(self.buffer[beg:end])
+        if len(els) < distance:
+            els.extend(bytes(distance - len(els)))  # Zero padding past the end
+
+        self.pos = beg + distance
+        self.release()
+        self.get()
+
+        if self.budget:
+            self.spend()
         return els
 
+    def array(self, type: str, size: int, byteorder: str = 'little'):
+        # Bulk read into a NumPy view over the buffer if available, otherwise into an array.array
+        typecode, dtype = BinaryParser.ARRAY_TYPES[type]
+        big = byteorder in ('big', '>', '!')
+        length = size * array.array(typecode).itemsize
+
+        if numpy is not None:
+            dtype = numpy.dtype(('>' if big else '<') + dtype)
+            if self.pos + length <= self.end and isinstance(self.buffer, (bytes, bytearray, mmap)):
+                values = numpy.frombuffer(self.buffer, dtype=dtype, count=size, offset=self.pos)
+                self.skip(length)
+                return values
+            return numpy.frombuffer(self.advance(length), dtype=dtype, count=size)
+
+        values = array.array(typecode)
+        values.frombytes(self.advance(length))
+        if big != (sys.byteorder == 'big'):
+            values.byteswap()
+        return values
+
     def byte(self) -> int:
+        if self.budget:
+            self.spend()
         return self.next() or 0
 
     def bytes(self, distance: int) -> bytearray:
@@ -95,42 +265,63 @@ class BinaryParser(Parser):
         return int.from_bytes(self.bytes(2), byteorder=byteorder)
 
     def int16_array(self, size: int, byteorder: str = 'little') -> list[int]:
-        return [self.int16(byteorder) for _ in range(size)]
+        return self.array('int16', size, byteorder).tolist()
 
     def int32(self, byteorder: str = 'little') -> int:
         return int.from_bytes(self.bytes(4), byteorder=byteorder)
 
     def int32_array(self, size: int, byteorder: str = 'little') -> list[int]:
-        return [self.int32(byteorder) for _ in range(size)]
+        return self.array('int32', size, byteorder).tolist()
 
     def int64(self, byteorder: str = 'little') -> int:
         return int.from_bytes(self.bytes(8), byteorder=byteorder)
 
     def int64_array(self, size: int, byteorder: str = 'little') -> list[int]:
-        return [self.int64(byteorder) for _ in range(size)]
+        return self.array('int64', size, byteorder).tolist()
 
     def float32(self, byteorder: str = '<') -> float:
         return unpack(byteorder + 'f', self.bytes(4))[0]
 
     def float32_array(self, size: int, byteorder: str = '<') -> list[float]:
-        return unpack(byteorder + ('f' * size), self.bytes(size * 4))
+        return self.array('float32', size, byteorder).tolist()
 
     def float64(self, byteorder: str = '<') -> float:
         return unpack(byteorder + 'd', self.bytes(8))[0]
 
     def float64_array(self, size: int, byteorder: str = '<') -> list[float]:
-        return unpack(byteorder + ('d' * size), self.bytes(size * 8))
+        return self.array('float64', size, byteorder).tolist()
 
     def string(self, size: int, encoding: str = 'utf-8') -> str:
         return self.bytes(size).decode(encoding)
 
     def collect_bytes(self) -> byte:
+        self.nodes += 1
+        if self.budget:
+            self.spend()
+
         self.nbeg = self.nend  # End of last node
         self.nend = self.pos  # End of current node
         return self.buffer[self.nbeg:self.nend]
 
+    def collect_view(self, cls: type = BinaryNode) -> BinaryNode:
+        self.nodes += 1
+        if self.budget:
+            self.spend()
+
+        self.nbeg = self.nend  # End of last node
+        self.nend = self.pos  # End of current node
+
+        # Windows drop their bytes, the view needs its own copy
+        if isinstance(self.buffer, Window):
+            return cls.view(bytes(self.buffer[self.nbeg:self.nend]), 0, self.nend - self.nbeg)
+
+        return cls.view(self.buffer, self.nbeg, self.nend - self.nbeg)
+
 
 class TextParser(Parser):
+    # Token types of the grammar, overridden by grammars or per parser
+    registry: TokenRegistry = default_registry
+
     class EmptyStreamException(Exception):
         def __init__(self, *args):
             super().__init__(*args)
@@ -146,7 +337,18 @@ class TextParser(Parser):
         filepath: Path = None,
         file: FileIO = None,
         stream: StringIO = None,
-        logger: Logger = logger):
+        logger: Logger = logger,
+        memoize: bool = False,
+        interner: TextInterner | bool = None,
+        node_table: NodeTable = None,
+        registry: TokenRegistry = None,
+        events: EventHandler = None,
+        retain_tokens: bool = True,
+        block_size: int = None,
+        budget: Budget = None):
+
+        if registry:
+            self.registry = registry
 
         if filename:
             filepath = Path(filename)
@@ -154,19 +356,167 @@ class TextParser(Parser):
         if filepath:
             file = filepath.open('r')
 
-        if file:
+        if file and block_size and not tokens:
+            # Lex the file while parsing, the source is never read as a whole
+            tokens = tokenize_blocks(file, block_size, registry=self.registry, interner=interner)
+        elif file:
             stream = file.read()
 
-        if not stream:
+        if not stream and not tokens:
             file_name = '' if file is None else f'"{file.name}"'
             logger.error(f'Empty stream {file_name}')
             raise TextParser.EmptyStreamException(f'No input given to parser! f{file_name}')
 
         if not tokens:
-            lexer = Lexer(filename=filename, filepath=filepath, file=file, stream=stream)
-            tokens = lexer.tokenize()
+            lexer = Lexer(filename=filename, filepath=filepath, file=file, stream=stream, registry=self.registry,
+                          interner=interner, spans=self.prescan(stream))
+            tokens = lexer.tokenize(budget)
+        elif not isinstance(tokens, (list, Window)):
+            tokens = Window(tokens)  # Token generator, only tokens that are not in nodes yet are kept
+
+        Parser.__init__(self, iterable=tokens, root=root, filename=filename, filepath=filepath, file=file, logger=logger,
+                        node_table=node_table)
+
+        # Event mode, nodes are passed to the handler instead of building the tree
+        if events:
+            self.root.events = events
+
+        # Speculative parsing
+        self.speculating: int = 0
+        self.memo: dict[tuple, tuple] | None = {} if memoize else None
+
+        # Without tokens nodes keep spans into the source, or their own text if only tokens were given
+        self.source: str | None = stream
+        self.retain_tokens: bool = retain_tokens
+
+        # Shared by lexing and parsing
+        self.budget = budget
+
+    def finish(self, root: Node) -> None:
+        if not self.retain_tokens:
+            release_tokens(root, self.source)
+
+            # Drop the token buffer, the parser is exhausted
+            self.buffer = []
+            self.pos = self.end = self.nbeg = self.nend = 0
+            self.el = None
+            if self.memo is not None:
+                self.memo = {}
+
+    def prescan(self, stream: str) -> list[tuple[int, int, int]] | None:
+        # Source ranges (beg, end, type) the grammar recognizes without the lexer
+        return None
+
+    def parse_block(self):
+        raise NotImplementedError('Implement the "parse_block" method to parse event streams!')
+
+    def iterparse(self):
+        # Yield (event, node) pairs block by block without keeping top level nodes
+        events = EventQueue()
+        self.root.events = events
+
+        try:
+            while self:
+                self.parse_block()
+                yield from events.drain()
+        finally:
+            del self.root.events
 
-        Parser.__init__(self, iterable=tokens, root=root, filename=filename, filepath=filepath, file=file, logger=logger)
+    @classmethod
+    def split_blocks(cls, stream: str) -> list[int]:
+        # Offsets at which the grammar can start parsing independently of the preceding text
+        return []
+
+    @classmethod
+    def parse_parallel(cls,
+        filepath: Path = None,
+        stream: str = None,
+        root: Node = None,
+        workers: int = None,
+        chunk_size: int = 1 << 20,
+        **options) -> Node:
+
+        # Parse chunks between block boundaries in a process pool and stitch the top level nodes
+        if filepath:
+            filepath = Path(filepath)
+            stream = filepath.read_text()
+
+        node_table = options.pop('node_table', None)
+        retain_tokens = options.pop('retain_tokens', True)
+
+        offsets = [0]
+        for offset in cls.split_blocks(stream):
+            if offset - offsets[-1] >= chunk_size:
+                offsets.append(offset)
+
+        chunks = []
+        row = 0
+        for beg, end in zip(offsets, offsets[1:] + [len(stream)]):
+            if chunks:
+                row += stream.count(TK.LineFeed, chunks[-1][1] + 1, beg + 1)
+            col = location(stream, beg)[1] if beg else 0
+            chunks.append((stream[beg:end], beg, row, col))
+
+        args = [cls] * len(chunks), *zip(*chunks), [options] * len(chunks)
+
+        if len(chunks) == 1 or workers == 1:
+            results = list(map(parse_chunk, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(parse_chunk, *args))
+
+        if root is None:
+            root = Document(filepath) if filepath else Node()
+
+        for nodes in results:
+            for node in nodes:
+                root.add(node)
+
+        if not retain_tokens:
+            release_tokens(root, stream)
+
+        if node_table is not None:
+            node_table.canonicalize(root)
+
+        return root
+
+    def mark(self) -> tuple[int, int, int]:
+        return self.pos, self.nbeg, self.nend
+
+    def reset(self, mark: tuple[int, int, int]) -> None:
+        self.pos, self.nbeg, self.nend = mark
+        self.get()
+
+    def attempt(self, rule, *args):
+        # Run a rule speculatively, returns None and resets the position if the rule fails.
+        # Outcomes are memoized per (rule, arguments, position), so such rules should return their
+        # node instead of adding it to the scope. Rules with unhashable arguments are not memoized.
+        key = (getattr(rule, '__func__', rule), args, self.pos)
+        try:
+            hash(key)
+        except TypeError:
+            key = None
+
+        if self.memo is not None and key in self.memo:
+            result, mark = self.memo[key]
+            if mark:
+                self.reset(mark)
+            return result
+
+        mark = self.mark()
+        self.speculating += 1
+        try:
+            result = rule(*args)
+        except TextParser.UnexpectedTokenException:
+            self.reset(mark)
+            result = None
+        finally:
+            self.speculating -= 1
+
+        if self.memo is not None and key is not None:
+            self.memo[key] = (result, self.mark() if result is not None else None)
+
+        return result
 
     def consume(self, type: TK) -> bool:
         if self.get() and self.get().type == type:
@@ -185,48 +535,56 @@ class TextParser(Parser):
         return False
 
     def consume_until(self, type: TK) -> bool:
-        pos = self.pos
-        while self.get() and self.get().type != type:
-            self.next()
-        return self.pos - pos > 0
+        buffer, pos = self.buffer, self.pos
+        while pos < self.end and buffer[pos].type != type:
+            pos += 1
+        return self.advance_to(pos)
 
     def consume_until_any(self, types: list[TK]) -> bool:
-        pos = self.pos
-        while self.get() and self.get().type not in types:
-            self.next()
-        return self.pos - pos > 0
+        buffer, pos = self.buffer, self.pos
+        while pos < self.end and buffer[pos].type not in types:
+            pos += 1
+        return self.advance_to(pos)
 
     def consume_while(self, type: TK) -> bool:
-        pos = self.pos
-        while self.get() and self.get().type == type:
-            self.next()
-        return self.pos - pos > 0
+        buffer, pos = self.buffer, self.pos
+        while pos < self.end and buffer[pos].type == type:
+            pos += 1
+        return self.advance_to(pos)
 
     def consume_while_any(self, types: list[TK]) -> bool:
-        pos = self.pos
-        while self.get() and self.get().type in types:
-            self.next()
-        return self.pos - pos > 0
+        buffer, pos = self.buffer, self.pos
+        while pos < self.end and buffer[pos].type in types:
+            pos += 1
+        return self.advance_to(pos)
+
+    def advance_to(self, pos: int) -> bool:
+        moved = pos > self.pos
+        self.jump(pos)
+
+        if self.budget:
+            self.spend()
+        return moved
 
     def discard(self) -> list[Token]:
         self.next()
-        return self.collect_tokens()
+        return self.take_tokens()
 
     def discard_until(self, type: TK) -> list[Token]:
         self.consume_until(type)
-        return self.collect_tokens()
+        return self.take_tokens()
 
     def discard_until_any(self, types: list[TK]) -> list[Token]:
         self.consume_until_any(types)
-        return self.collect_tokens()
+        return self.take_tokens()
 
     def discard_while(self, type: TK) -> list[Token]:
         self.consume_while(type)
-        return self.collect_tokens()
+        return self.take_tokens()
 
     def discard_while_any(self, types: list[TK]) -> list[Token]:
         self.consume_while_any(types)
-        return self.collect_tokens()
+        return self.take_tokens()
 
     def number_of_tokens(self) -> int:
         return self.pos - self.nend
@@ -238,22 +596,71 @@ class TextParser(Parser):
         return sum(map(lambda x: len(x.text), self.buffer[:self.pos]))
 
     def collect_tokens(self) -> list[Token]:
+        self.nodes += 1
+        if self.budget:
+            self.spend()
+
+        return self.take_tokens()
+
+    def take_tokens(self) -> list[Token]:
+        # Tokens of the current node, without counting it as one
         self.nbeg = self.nend  # End of last node
         self.nend = self.pos  # End of current node
-        return self.buffer[self.nbeg:self.nend]
+        tokens = self.buffer[self.nbeg:self.nend]
+
+        # Collected tokens are not needed anymore unless the parser may backtrack
+        if not self.speculating and isinstance(self.buffer, Window):
+            self.buffer.release(self.nend)
+
+        return tokens
 
     def error(self, expected: TK) -> None:
+        if self.speculating:
+            raise TextParser.UnexpectedTokenException(expected)
+
         nl = '\n'
-        t: Token = self.get()
+        t: Token | None = self.get()
         tokens = self.buffer[self.nend:self.pos + 1]
         text = "".join(list(map(lambda x: x.text, tokens)))
-        indent = len(text[text.rfind(nl)]) if text.find('\n') > -1 else len(text) - len(tokens[-1].text)
 
-        msg = f'\n\n{self.filepath.absolute()}: Line {t.row} Col {t.col}\n\n'
+        if t is None:
+            # At the end of the stream point past the last token
+            t = tokens[-1] if tokens else Token()
+            got, width, indent = '<eof>', 1, len(text)
+        else:
+            got, width = tokens[-1].text, len(t.text)
+            indent = len(text[text.rfind(nl)]) if text.find('\n') > -1 else len(text) - len(tokens[-1].text)
+
+        location = self.filepath.absolute() if self.filepath else '<stream>'
+        msg = f'\n\n{location}: Line {t.row} Col {t.col}\n\n'
         msg += f'{text}\n'
-        msg += f'{indent * " "}{"^" * len(self.get().text)}\n\n'
-        msg += f'Expected \'{expected}\' got \'{tokens[-1].text}\'\n'
+        msg += f'{indent * " "}{"^" * width}\n\n'
+        msg += f'Expected \'{expected}\' got \'{got}\'\n'
         msg += f'Last tokens: {self.tokens()}\n'
 
-        self.logger.error(f'Unexpected token {self.filepath}: Expected \'{expected}\' got \'{tokens[-1].text}\'')
+        self.logger.error(f'Unexpected token {self.filepath}: Expected \'{expected}\' got \'{got}\'')
         raise TextParser.UnexpectedTokenException(msg)
+
+
+def release_tokens(root: Node, source: str | None) -> None:
+    # Placeholders release the tokens of their nodes when they are built
+    for node in root.walk_built():
+        if hasattr(node, 'release_tokens'):
+            node.release_tokens(source)
+
+
+def parse_chunk(cls: type, stream: str, offset: int, row: int, col: int, options: dict) -> list[Node]:
+    # Parse a chunk on its own and move its nodes and tokens to their place in the whole stream
+    nodes = cls(stream=stream, **options).parse().children
+    tokens = {}
+
+    for node in nodes:
+        node.parent = None
+
+        # Placeholders refer to the source of the chunk, they are built here and rebased with the rest
+        for child in node.walk():
+            for token in getattr(child, 'tokens', None) or []:
+                tokens[id(token)] = token
+
+    rebase(list(tokens.values()), offset, row, col)
+    return nodes
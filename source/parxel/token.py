@@ -1,9 +1,10 @@
+from functools import lru_cache
+from sys import getsizeof
+
+
 class TK:
     def __class_getitem__(cls, sym: str) -> int:
-        for k, v in TK.__dict__.items():
-            if v == sym:
-                return TK.__dict__[k]
-        return TK.Undefined
+        return TK.lookup.get(sym, TK.Undefined)
 
     Undefined = 0
 
@@ -28,6 +29,64 @@ class TK:
     Word = 0xF2  # Alphanumeric
 
 
+TK.lookup = {v: v for k, v in TK.__dict__.items() if not k.startswith('__') and isinstance(v, (str, int))}
+
+
+@lru_cache(maxsize=32)
+def compile_operators(operators: tuple[tuple[str, int], ...]) -> dict:
+    # Character trie, the token type of a complete operator is stored under the None key
+    trie = {}
+    for text, type in operators:
+        node = trie
+        for c in text:
+            node = node.setdefault(c, {})
+        node[None] = type
+    return trie
+
+
+class TokenRegistry:
+    def __init__(self,
+        whitespaces: list[str] = None,
+        symbols: list[str] = None,
+        operators: list[str] | dict[str, int] = None,
+        coalesce: bool | list[str] = False,
+        **tokens):
+
+        self.whitespaces: list[str] = list(TK.Whitespaces if whitespaces is None else whitespaces)
+        self.symbols: list[str] = list(TK.Symbols if symbols is None else symbols)
+
+        # Single character token types
+        self.types: dict[str, int] = {c: c for c in self.whitespaces + self.symbols}
+
+        # Multi-character operators and keywords
+        self.operators: dict = compile_operators(normalize_operators(operators))
+
+        # Whitespace kinds whose runs are collapsed into a single token
+        self.coalesce: str = ''.join(self.whitespaces) if coalesce is True else ''.join(coalesce or [])
+
+        # Grammar specific token types and token classes
+        for name, value in tokens.items():
+            setattr(self, name, frozenset(value) if isinstance(value, (list, tuple, set)) else value)
+
+    def __getitem__(self, sym: str) -> int:
+        return self.types.get(sym, TK.Undefined)
+
+    def __getattr__(self, name: str):
+        # Fall back to the common token types
+        return getattr(TK, name)
+
+
+def normalize_operators(operators: list[str] | dict[str, int] = None) -> tuple[tuple[str, int], ...]:
+    if not operators:
+        return ()
+    if not isinstance(operators, dict):
+        operators = {text: text for text in operators}
+    return tuple(sorted(operators.items()))
+
+
+default_registry = TokenRegistry()
+
+
 class Token:
     def __init__(self, beg: int = 0, end: int = 0, row: int = 0, col: int = 0, type: TK = TK.Undefined, text: str = ''):
         self.beg = beg
@@ -37,5 +96,46 @@ class Token:
         self.type = type
         self.text = text
 
+    @property
+    def length(self) -> int:
+        return self.end - self.beg
+
     def __repr__(self):
         return f'{bytes(self.text, encoding="utf-8")}'
+
+
+class TextInterner:
+    def __init__(self, capacity: int = 1 << 16, max_length: int = 64):
+        self.capacity: int = capacity
+        self.max_length: int = max_length
+        self.table: dict[str, str] = {}
+
+        # Statistics
+        self.hits: int = 0
+        self.misses: int = 0
+        self.saved: int = 0
+
+    def __call__(self, text: str) -> str:
+        shared = self.table.get(text)
+        if shared is not None:
+            self.hits += 1
+            self.saved += getsizeof(text)
+            return shared
+
+        self.misses += 1
+        if len(self.table) < self.capacity and len(text) <= self.max_length:
+            self.table[text] = text
+        return text
+
+    def report(self) -> dict[str, int]:
+        return {
+            'entries': len(self.table),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'saved_bytes': self.saved
+        }
+
+
+# Interning table shared by all lexers of the process
+shared_interner = TextInterner()
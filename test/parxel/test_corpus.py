@@ -0,0 +1,74 @@
+from source.parxel.corpus import Corpus
+from source.parxel.nodes import Document
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from unittest import TestCase
+import os
+
+
+class CorpusTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        self.parsed: list[Path] = []
+
+        (self.path / 'sub').mkdir()
+        (self.path / 'a.md').write_text('a')
+        (self.path / 'sub' / 'b.md').write_text('b')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def parse(self, filepath: Path) -> Document:
+        self.parsed.append(filepath)
+        return Document(filepath)
+
+    def test_refresh(self):
+        corpus = Corpus(self.path, self.parse)
+
+        changes = corpus.refresh()
+        self.assertEqual(len(changes.added), 2)
+        self.assertEqual(len(self.parsed), 2)
+        self.assertEqual(corpus.children[1].type(), 'Folder')
+        self.assertIs(corpus.document(self.path / 'sub' / 'b.md').parent, corpus.children[1])
+
+        # Unchanged files are not parsed again
+        self.assertFalse(corpus.refresh())
+        self.assertEqual(len(self.parsed), 2)
+
+        # Touched but identical content
+        os.utime(self.path / 'a.md', ns=(0, 0))
+        self.assertFalse(corpus.refresh())
+        self.assertEqual(len(self.parsed), 2)
+
+        # Changed, added and removed files are patched in place
+        old = corpus.document(self.path / 'a.md')
+        (self.path / 'a.md').write_text('changed')
+        (self.path / 'c.md').write_text('c')
+        (self.path / 'sub' / 'b.md').unlink()
+
+        changes = corpus.refresh()
+        self.assertEqual(changes.changed, [self.path / 'a.md'])
+        self.assertEqual(changes.added, [self.path / 'c.md'])
+        self.assertEqual(changes.removed, [self.path / 'sub' / 'b.md'])
+        self.assertEqual(len(self.parsed), 4)
+
+        self.assertIsNot(corpus.document(self.path / 'a.md'), old)
+        self.assertEqual([c.filepath.name for c in corpus.children], ['a.md', 'c.md'])
+
+    def test_watch(self):
+        corpus = Corpus(self.path, self.parse)
+        stop = Event()
+        seen = []
+
+        def callback(changes):
+            seen.append(changes)
+            stop.set()
+
+        thread = Thread(target=corpus.watch, args=(0.01, callback, stop))
+        thread.start()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(seen[0].added), 2)
@@ -1,4 +1,4 @@
-from source.parxel.iterator import Iterator
+from source.parxel.iterator import Iterator, Window
 from unittest import TestCase
 from random import randint 
 
@@ -37,6 +37,66 @@ class IteratorTest(TestCase):
         self.assertEqual(it.consume('i'), True)
         self.assertEqual(it.consume_any(' '), True)
 
+    def test_mark_reset(self):
+        it = Iterator('bli kla dub')
+
+        mark = it.mark()
+        it.consume_until(' ')
+        self.assertEqual(it.get(), ' ')
+
+        it.reset(mark)
+        self.assertEqual(it.pos, 0)
+        self.assertEqual(it.get(), 'b')
+
+    def test_scanning(self):
+        for buffer in ('aaab  cd;e', b'aaab  cd;e', list('aaab  cd;e')):
+            space = 32 if isinstance(buffer, bytes) else ' '
+            semicolon = 59 if isinstance(buffer, bytes) else ';'
+            letters = b'abcd' if isinstance(buffer, bytes) else 'abcd'
+
+            it = Iterator(buffer)
+            it.consume_while(buffer[0])
+            self.assertEqual(it.pos, 3)
+            it.consume_while_any(letters)
+            self.assertEqual(it.pos, 4)
+            it.consume_until(semicolon)
+            self.assertEqual(it.pos, 8)
+
+            it = Iterator(buffer)
+            it.consume_until_any([space, semicolon])
+            self.assertEqual(it.pos, 4)
+            it.consume_until('x' if not isinstance(buffer, bytes) else 120)
+            self.assertFalse(it)
+
+        it = Iterator('bli kla')
+        self.assertEqual(it.advance(3), 'bli')
+        self.assertEqual(it.get(), ' ')
+
+    def test_window(self):
+        window = Window(iter('aaab  cd;e'), history=1, batch=2)
+        it = Iterator(window)
+
+        # The end is unknown until it is reached
+        self.assertEqual(it.end, len(window))
+        it.consume_while('a')
+        self.assertEqual(it.get(), 'b')
+        it.consume_until(';')
+        self.assertEqual((it.pos, it.get(), it.peek()), (8, ';', 'e'))
+        self.assertEqual(it.end, 10)
+
+        # Released items are dropped except the history
+        window.release(8)
+        self.assertEqual(window.base, 7)
+        self.assertEqual(window[7:10], ['d', ';', 'e'])
+        self.assertRaises(IndexError, window.__getitem__, 6)
+
+        it.consume_until('x')
+        self.assertFalse(it)
+        self.assertIsNone(it.next())
+
+        # Empty iterable
+        self.assertFalse(Iterator(Window(iter([]))))
+
     def test_complex_logic(self):
         it = Iterator([IteratorTest.ALPHABET[randint(0, 25)] for _ in range(20)])
 
@@ -1,6 +1,14 @@
-from source.parxel.lexer import Lexer
-from source.parxel.token import Token, TK
-from unittest import TestCase
+from source.parxel.budget import Budget
+from source.parxel.lexer import Lexer, numpy, tokenize_blocks, tokenize_parallel
+from source.parxel.token import Token, TK, TextInterner, TokenRegistry
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipIf
+
+
+def spans(tokens: list[Token]) -> list[tuple]:
+    return [(t.beg, t.end, t.row, t.col, t.type, t.text) for t in tokens]
 
 
 class LexerTest(TestCase):
@@ -47,6 +55,145 @@ class LexerTest(TestCase):
             TK.Space, TK.Word, TK.ParanthesisOpen, TK.Number, TK.ParanthesisClose # exit(1)
         ])
 
+    def test_positions(self):
+        lex = Lexer(stream='ab 12\ncd\n\n  ef')
+        tokens = lex.tokenize()
+
+        self.assertEqual([(t.beg, t.end) for t in tokens], [
+            (0, 2), (2, 3), (3, 5), (5, 6), (6, 8), (8, 9), (9, 10), (10, 11), (11, 12), (12, 14)])
+        self.assertEqual([(t.row, t.col) for t in tokens], [
+            (0, 1), (0, 2), (0, 4), (1, 0), (1, 2), (2, 0), (3, 0), (3, 1), (3, 2), (3, 4)])
+
+    def test_operators(self):
+        # Longest match first
+        lex = Lexer(stream='a ** b *** c', operators=['**', '***'])
+        self.assertEqualTokens(lex.tokenize(), [TK.Word, TK.Space, '**', TK.Space, TK.Word, TK.Space, '***', TK.Space, TK.Word])
+
+        # Keywords only match whole words
+        lex = Lexer(stream='if ifx', operators={'if': 1})
+        self.assertEqualTokens(lex.tokenize(), [1, TK.Space, TK.Word])
+
+        # Unregistered prefixes fall back to single symbols
+        lex = Lexer(stream='-- ---', operators=['---'])
+        self.assertEqualTokens(lex.tokenize(), [TK.Minus, TK.Minus, TK.Space, '---'])
+
+    def test_interner(self):
+        # Identical texts share one object
+        lex = Lexer(stream='word word word', interner=True)
+        tokens = lex.tokenize()
+        self.assertIs(tokens[0].text, tokens[2].text)
+        self.assertIs(tokens[0].text, tokens[4].text)
+        self.assertEqual(lex.interner.report()['hits'], 2)
+        self.assertGreater(lex.interner.report()['saved_bytes'], 0)
+
+        # Bounded table, shared between lexers
+        interner = TextInterner(capacity=1)
+        Lexer(stream='one two', interner=interner).tokenize()
+        tokens = Lexer(stream='one two', interner=interner).tokenize()
+        self.assertEqual(interner.report()['entries'], 1)
+        self.assertEqual(interner.hits, 1)
+        self.assertEqual([t.text for t in tokens], ['one', ' ', 'two'])
+
+    def test_coalesce(self):
+        STRING = 'a   b\t\t\n\n  c'
+
+        # Default stream is unchanged
+        lex = Lexer(stream=STRING)
+        self.assertEqual(len(lex.tokenize()), 12)
+
+        # Runs of the same whitespace kind become one token
+        lex = Lexer(stream=STRING, coalesce=True)
+        tokens = lex.tokenize()
+        self.assertEqualTokens(tokens, [TK.Word, TK.Space, TK.Word, TK.HorizontalTabulator, TK.LineFeed, TK.Space, TK.Word])
+        self.assertEqual([t.length for t in tokens], [1, 3, 1, 2, 2, 2, 1])
+
+        # Only the selected kinds
+        lex = Lexer(stream=STRING, coalesce=[TK.Space])
+        self.assertEqualTokens(lex.tokenize(), [
+            TK.Word, TK.Space, TK.Word, TK.HorizontalTabulator, TK.HorizontalTabulator,
+            TK.LineFeed, TK.LineFeed, TK.Space, TK.Word])
+
+    def test_registry(self):
+        registry = TokenRegistry(symbols=['$', '='], operators=['=='], Assignment=['=', '=='])
+
+        lex = Lexer(stream='$a == b, c', registry=registry)
+        self.assertEqualTokens(lex.tokenize(), ['$', TK.Word, TK.Space, '==', TK.Space, TK.Word, TK.Symbol, TK.Space, TK.Word])
+        self.assertEqual(registry.Assignment, frozenset(['=', '==']))
+        self.assertEqual(registry.Word, TK.Word)
+        self.assertEqual(registry['$'], '$')
+        self.assertEqual(registry['#'], TK.Undefined)
+
+        # Default registry and global token types are untouched
+        lex = Lexer(stream='$a')
+        self.assertEqualTokens(lex.tokenize(), [TK.Symbol, TK.Word])
+        self.assertFalse(hasattr(TK, 'Assignment'))
+        self.assertEqual(TK['#'], TK.NumberSign)
+
+    def test_spans(self):
+        STRING = 'a, b\nplain line\nc'
+
+        lex = Lexer(stream=STRING, spans=[(5, 15, 0xF3)])
+        tokens = lex.tokenize()
+        self.assertEqualTokens(tokens, [TK.Word, TK.Comma, TK.Space, TK.Word, TK.LineFeed, 0xF3, TK.LineFeed, TK.Word])
+        self.assertEqual((tokens[5].text, tokens[5].beg, tokens[5].end, tokens[5].row), ('plain line', 5, 15, 1))
+        self.assertEqual((tokens[7].row, tokens[7].col), (2, 1))
+
+    def test_parallel(self):
+        STRING = 'def  func(a):\n\treturn a  # ä\r\n\n' * 50
+
+        registry = TokenRegistry(operators=['#'], coalesce=[TK.Space])
+        for options in [{}, {'registry': registry}]:
+            expected = spans(Lexer(stream=STRING, **options).tokenize())
+            self.assertEqual(spans(tokenize_parallel(stream=STRING, chunk_size=64, workers=2, **options)), expected)
+
+        # Memory mapped file with universal newlines
+        with TemporaryDirectory() as tmp:
+            filepath = Path(tmp) / 'input.txt'
+            filepath.write_bytes(STRING.encode('utf-8'))
+
+            with filepath.open('r', encoding='utf-8') as file:
+                expected = spans(Lexer(stream=file.read()).tokenize())
+            self.assertEqual(spans(tokenize_parallel(filepath=filepath, chunk_size=64, workers=2)), expected)
+
+    def test_blocks(self):
+        STRING = 'def  func(a):\n\treturn a  # xyz\n\n' * 20 + 'x' * 100
+
+        registry = TokenRegistry(operators=['#', 'a  #'], coalesce=[TK.Space])
+        for options in [{}, {'registry': registry}]:
+            expected = spans(Lexer(stream=STRING, **options).tokenize())
+            tokens = tokenize_blocks(StringIO(STRING), 16, **options)
+            self.assertEqual(next(tokens).text, 'def')
+            self.assertEqual(spans(tokens), expected[1:])
+
+    def test_budget(self):
+        STRING = 'word ' * 1000
+
+        with self.assertRaises(Budget.ExceededException) as context:
+            Lexer(stream=STRING).tokenize(Budget(max_tokens=100, interval=16))
+        self.assertEqual(context.exception.reason, 'tokens')
+        self.assertLessEqual(len(context.exception.partial), 100 + 16)
+
+        budget = Budget(timeout=60)
+        budget.cancel()
+        with self.assertRaises(Budget.ExceededException) as context:
+            Lexer(stream=STRING).tokenize(budget)
+        self.assertEqual(context.exception.reason, 'cancelled')
+
+        self.assertEqual(len(Lexer(stream=STRING).tokenize(Budget(timeout=60, max_tokens=2000))), 2000)
+
+    @skipIf(numpy is None, 'NumPy is not installed')
+    def test_vectorized(self):
+        STRING = 'def  func(a1, 2b_c):\n\treturn 12ab3 + _x9  # é€ xyz\n\n\r\n' * 20
+
+        registry = TokenRegistry(symbols=['(', ')', '€'], coalesce=[TK.Space, TK.LineFeed])
+        for options in [{}, {'coalesce': True}, {'registry': registry}, {'operators': ['return']}]:
+            expected = spans(Lexer(stream=STRING, **options).tokenize())
+            self.assertEqual(spans(Lexer(stream=STRING, vectorized=True, **options).tokenize()), expected)
+
+        # Lone surrogates of undecodable bytes
+        STRING = b'ab \xff cd'.decode('utf-8', 'surrogateescape')
+        self.assertEqual(spans(Lexer(stream=STRING, vectorized=True).tokenize()), spans(Lexer(stream=STRING).tokenize()))
+
     def test_(self):
         # Whitespace string
         lex = Lexer(stream=LexerTest.WHITESPACE_STRING)
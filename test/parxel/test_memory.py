@@ -0,0 +1,42 @@
+from source.parxel.lexer import Lexer
+from source.parxel.memory import footprint
+from source.parxel.nodes import LexicalNode, Node
+from sys import getsizeof
+from unittest import TestCase
+
+
+class Line(LexicalNode):
+    pass
+
+
+class MemoryTest(TestCase):
+    def setUp(self):
+        stream = ''.join(f'line number {i} with some words\n' for i in range(2000))
+        self.tokens = Lexer(stream=stream).tokenize()
+
+        self.root = Node()
+        for i in range(0, len(self.tokens), 12):
+            Line(self.tokens[i:i + 12], parent=self.root)
+
+    def test_footprint(self):
+        result = footprint(self.root)
+        report = result.report()
+
+        self.assertEqual(list(report['nodes']), ['Line', 'Node'])
+        self.assertGreater(report['tokens'], 0)
+        self.assertGreater(report['strings'], 0)
+        self.assertGreater(report['containers'], 0)
+        self.assertEqual(result.total, report['tokens'] + report['strings'] + report['containers'] +
+                         sum(report['nodes'].values()) + report['other'])
+
+        # Shared objects are counted once, parents are not followed
+        self.assertEqual(footprint(self.root, self.root).total, result.total)
+        self.assertEqual(footprint(self.root, self.tokens).total, result.total + getsizeof(self.tokens))
+        child = footprint(self.root.children[0])
+        self.assertEqual(list(child.report()['nodes']), ['Line'])
+
+    def test_sample(self):
+        exact = footprint(self.root).tokens
+        sampled = footprint(self.root, sample=4).tokens
+
+        self.assertAlmostEqual(sampled / exact, 1, delta=0.2)
@@ -0,0 +1,165 @@
+from source.parxel.nodes import Document, LexicalNode, Node, NodeTable, defer
+from source.parxel.lexer import Lexer
+from source.parxel.token import TK, Token
+from pickle import dumps, loads
+from unittest import TestCase
+
+
+class Leaf(LexicalNode):
+    def __init__(self, text: str, parent: Node = None):
+        super().__init__([Token(text=text)], parent)
+
+
+class Block(Node):
+    def __init__(self, *texts: str, parent: Node = None):
+        super().__init__(parent)
+
+        for text in texts:
+            Leaf(text, parent=self)
+
+
+class NodeTest(TestCase):
+    def tree(self, *blocks: tuple[str]) -> Node:
+        root = Node()
+        for texts in blocks:
+            root.add(Block(*texts))
+        return root
+
+    def test_hash(self):
+        self.assertEqual(self.tree(('a', 'b')).hash(), self.tree(('a', 'b')).hash())
+        self.assertNotEqual(self.tree(('a', 'b')).hash(), self.tree(('a', 'c')).hash())
+
+        # Fingerprints are kept on the nodes until the tree changes
+        root = self.tree(('a', 'b'), ('c',))
+        fingerprint = root.fingerprint()
+        self.assertEqual(fingerprint, self.tree(('a', 'b'), ('c',)).hash())
+        self.assertIsNotNone(root.children[0].digests)
+
+        root.children[0].add(Leaf('d'))
+        self.assertIsNone(root.digests)
+        self.assertIsNone(root.children[0].digests)
+        self.assertIsNotNone(root.children[1].digests)
+        self.assertNotEqual(root.fingerprint(), fingerprint)
+        self.assertEqual(root.fingerprint(), self.tree(('a', 'b', 'd'), ('c',)).hash())
+
+    def test_diff_identical(self):
+        self.assertFalse(self.tree(('a', 'b'), ('c',)).diff(self.tree(('a', 'b'), ('c',))))
+
+    def test_diff_changed(self):
+        old = self.tree(('a', 'b'), ('c',))
+        new = self.tree(('a', 'x'), ('c',))
+
+        diff = old.diff(new)
+        self.assertEqual(len(diff.changed), 1)
+        self.assertEqual(diff.changed[0][0].raw(), 'b')
+        self.assertEqual(diff.changed[0][1].raw(), 'x')
+        self.assertFalse(diff.inserted or diff.removed or diff.moved)
+
+    def test_diff_inserted_removed(self):
+        old = self.tree(('a',), ('b',))
+        new = self.tree(('a',), ('b',), ('c',))
+
+        diff = old.diff(new)
+        self.assertEqual(len(diff.inserted), 1)
+        self.assertEqual(diff.inserted[0].children[0].raw(), 'c')
+
+        diff = new.diff(old)
+        self.assertEqual(len(diff.removed), 1)
+        self.assertEqual(diff.removed[0].children[0].raw(), 'c')
+
+    def test_diff_moved(self):
+        old = self.tree(('a',), ('b',), ('c',))
+        new = self.tree(('c',), ('a',), ('b',))
+
+        diff = old.diff(new)
+        self.assertEqual(len(diff.moved), 1)
+        self.assertEqual(diff.moved[0][0].children[0].raw(), 'c')
+        self.assertFalse(diff.inserted or diff.removed or diff.changed)
+
+    def test_node_table(self):
+        table = NodeTable()
+        first = Document('first')
+        second = Document('second')
+        for doc, texts in ((first, ('a', 'b')), (second, ('a', 'c'))):
+            doc.add(Block(*texts))
+            doc.add(Block('license'))
+
+        hashes = [first.hash(), second.hash()]
+        table.canonicalize(first)
+        table.canonicalize(second)
+
+        self.assertIs(first.children[1], second.children[1])
+        self.assertIsNot(first.children[0], second.children[0])
+        self.assertIs(first.children[0].children[0], second.children[0].children[0])
+        self.assertEqual(table.hits, 2)
+
+        # Structure is unchanged
+        self.assertEqual([first.hash(), second.hash()], hashes)
+
+    def test_defer(self):
+        calls = []
+
+        def build():
+            calls.append(1)
+            return Block('a', 'b')
+
+        root = Node()
+        placeholder = defer(Block, build, parent=root)
+
+        # Nothing is built until the children are accessed
+        self.assertIsInstance(placeholder, Block)
+        self.assertEqual(placeholder.type(), 'Block')
+        self.assertIs(placeholder.parent, root)
+        self.assertEqual(calls, [])
+
+        self.assertEqual([leaf.raw() for leaf in placeholder.children], ['a', 'b'])
+        self.assertIs(type(placeholder), Block)
+        self.assertIs(placeholder.children[0].parent, placeholder)
+        self.assertEqual(root.hash(), self.tree(('a', 'b')).hash())
+        self.assertEqual(calls, [1])
+
+        # Walking and pickling expand placeholders as well
+        self.assertEqual(len(list(defer(Block, build).walk())), 3)
+        self.assertEqual(loads(dumps(defer(Block, build))).hash(), Block('a', 'b').hash())
+
+    def test_span_index(self):
+        # Lines of words, 'aa bb' is at 0 to 5, 'cc' at 6 to 8
+        tokens = Lexer(stream='aa bb\ncc\ndd ee ff\n').tokenize()
+        root = Node()
+        line = Node(parent=root)
+        for token in tokens:
+            if token.type == TK.LineFeed:
+                line = Node(parent=root)
+            elif token.type == TK.Word:
+                LexicalNode([token], parent=line)
+
+        first, second = root.children[:2]
+        self.assertEqual(first.span(), (0, 5))
+        self.assertIs(root.node_at(3), first.children[1])
+        self.assertIs(root.node_at(2), first)  # Between words
+        self.assertIsNone(root.node_at(100))
+        self.assertEqual(root.nodes_in_range(4, 7), [first, first.children[1], second, second.children[0]])
+        self.assertEqual(root.nodes_in_range(5, 6), [])
+
+        # Stays valid when nodes are added
+        LexicalNode(Lexer(stream='x' * 30).tokenize(), parent=second)
+        self.assertEqual(second.span(), (0, 30))
+        self.assertIs(root.node_at(20), second.children[1])
+
+        # Placeholders are indexed by their extent and only built when a query reaches into them,
+        # the extent only bounds the span of the built node
+        def build():
+            calls.append(1)
+            block = Block()
+            LexicalNode([Token(beg=44, end=48, text='word')], parent=block)
+            return block
+
+        calls = []
+        placeholder = defer(Block, build, parent=root, extent=(40, 50))
+        self.assertIs(root.node_at(20), second.children[1])
+        self.assertEqual(calls, [])
+        self.assertIsNone(root.node_at(42))
+        self.assertEqual(calls, [1])
+        self.assertEqual(placeholder.span(), (44, 48))
+        self.assertIs(root.node_at(45), placeholder.children[0])
+        self.assertEqual(calls, [1])
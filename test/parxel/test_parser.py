@@ -1,9 +1,35 @@
+from source.parxel.budget import Budget
 from source.parxel.nodes import BinaryNode, LexicalNode
-from source.parxel.parser import BinaryParser, Node, TextParser
+from source.parxel.parser import BinaryParser, EventHandler, Node, TextParser
 from source.parxel.token import TK
+from pathlib import Path
+from io import BytesIO
+from struct import pack
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
 
+# Grammars used from worker processes have to be importable
+class Lines(TextParser):
+    def parse_format(self):
+        while self:
+            if self.get().type == TK.LineFeed:
+                self.discard()
+                continue
+            self.consume_until(TK.LineFeed)
+            self.root.add(LexicalNode(self.collect_tokens()))
+        return self.root
+
+    @classmethod
+    def split_blocks(cls, stream):
+        return [i for i, c in enumerate(stream) if c == '\n']
+
+
+def spans(root: Node) -> list[list[tuple]]:
+    # Token positions of the top level nodes
+    return [[(t.beg, t.end, t.row, t.col, t.text) for t in node.tokens] for node in root.children]
+
+
 class TextParserTest(TestCase):
     def test_grammar(self):
 
@@ -38,7 +64,198 @@ class TextParserTest(TestCase):
 
             fun = Fun(name)
             doc.add(fun)
-        
+
+    def test_attempt(self):
+        parser = TextParser(stream='fun caller; end')
+
+        def keyword(word):
+            parser.consume_strict(TK.Word)
+            tokens = parser.collect_tokens()
+            if tokens[0].text != word:
+                parser.error(word)
+            return tokens
+
+        # Failing alternative resets the position
+        self.assertIsNone(parser.attempt(keyword, 'end'))
+        self.assertEqual(parser.pos, 0)
+
+        tokens = parser.attempt(keyword, 'fun')
+        self.assertEqual(tokens[0].text, 'fun')
+        self.assertEqual(parser.pos, 1)
+
+    def test_error_at_end(self):
+        for stream in ['fun', 'fun caller']:
+            parser = TextParser(stream=stream)
+            parser.consume_strict(TK.Word)
+            while parser:
+                parser.next()
+
+            with self.assertRaises(TextParser.UnexpectedTokenException) as context:
+                parser.consume_strict(TK.Word)
+            self.assertIn("got '<eof>'", str(context.exception))
+
+    def test_attempt_memoized(self):
+        parser = TextParser(stream='fun caller', memoize=True)
+        calls = []
+
+        def word():
+            calls.append(parser.pos)
+            parser.consume_strict(TK.Word)
+            return parser.collect_tokens()
+
+        mark = parser.mark()
+        first = parser.attempt(word)
+        parser.reset(mark)
+        second = parser.attempt(word)
+
+        self.assertIs(first, second)
+        self.assertEqual(calls, [0])
+        self.assertEqual(parser.pos, 1)
+
+        # Failures are memoized as well
+        self.assertIsNone(parser.attempt(word))
+        self.assertIsNone(parser.attempt(word))
+        self.assertEqual(calls, [0, 1])
+
+    def test_attempt_memoized_arguments(self):
+        parser = TextParser(stream='fun caller; end', memoize=True)
+
+        def keyword(word):
+            parser.consume_strict(TK.Word)
+            tokens = parser.collect_tokens()
+            if tokens[0].text != word:
+                parser.error(word)
+            return tokens
+
+        def other(word):
+            return keyword(word)
+        other.__name__ = keyword.__name__
+
+        # Outcomes depend on the arguments and on the rule, not on its name
+        self.assertIsNone(parser.attempt(keyword, 'end'))
+        self.assertEqual(parser.attempt(keyword, 'fun')[0].text, 'fun')
+
+        parser.reset((0, 0, 0))
+        self.assertEqual(parser.attempt(other, 'fun')[0].text, 'fun')
+        self.assertIsNone(parser.attempt(keyword, ['fun']))  # Unhashable arguments are not memoized
+
+
+    def test_events(self):
+        class Word(LexicalNode):
+            pass
+
+        class Line(Node):
+            pass
+
+        class Lines(TextParser):
+            def parse_format(self):
+                while self:
+                    self.parse_block()
+                return self.root
+
+            def parse_block(self):
+                self.root.enter_scope(Line())
+                while self and self.get().type != TK.LineFeed:
+                    if self.consume(TK.Word):
+                        self.root.add_to_scope(Word(self.collect_tokens()))
+                    else:
+                        self.discard()
+                self.discard()
+                self.root.exit_scope()
+
+        STRING = 'one two\nthree\n'
+
+        # Generator
+        events = [(event, node.type()) for event, node in Lines(stream=STRING).iterparse()]
+        self.assertEqual(events, [
+            ('enter', 'Line'), ('leaf', 'Word'), ('leaf', 'Word'), ('leave', 'Line'),
+            ('enter', 'Line'), ('leaf', 'Word'), ('leave', 'Line')])
+
+        # Handler, top level nodes are not kept
+        class Collect(EventHandler):
+            def __init__(self):
+                self.lines = []
+
+            def leave(self, node):
+                self.lines.append([word.raw() for word in node.children])
+
+        handler = Collect()
+        root = Lines(stream=STRING, events=handler).parse()
+        self.assertEqual(handler.lines, [['one', 'two'], ['three']])
+        self.assertEqual(root.children, [])
+
+        # Tree mode is unchanged
+        root = Lines(stream=STRING).parse()
+        self.assertEqual(len(root.children), 2)
+
+    def test_parse_parallel(self):
+        STRING = 'one two\n  three\n\nfour 4\n'
+
+        expected = spans(Lines(stream=STRING).parse())
+
+        for workers in [1, 2]:
+            root = Lines.parse_parallel(stream=STRING, workers=workers, chunk_size=1)
+            self.assertEqual(spans(root), expected)
+            self.assertTrue(all(node.parent is root for node in root.children))
+
+    def test_release_tokens(self):
+        STRING = 'one two\n  three\n\nfour 4\n'
+
+        expected = [(node.raw(), node.span()) for node in Lines(stream=STRING).parse().children]
+
+        parser = Lines(stream=STRING, retain_tokens=False)
+        root = parser.parse()
+        self.assertEqual([(node.raw(), node.span()) for node in root.children], expected)
+        self.assertTrue(all(node.tokens is None for node in root.children))
+        self.assertEqual((root.children[1].row, root.children[1].col), (1, 1))
+        self.assertEqual(parser.buffer, [])
+
+        root = Lines.parse_parallel(stream=STRING, workers=1, chunk_size=1, retain_tokens=False)
+        self.assertEqual([(node.raw(), node.span()) for node in root.children], expected)
+
+        # Nodes of tokens given without a source keep their own text
+        root = Lines(tokens=Lines(stream=STRING).buffer, retain_tokens=False).parse()
+        self.assertEqual([(node.raw(), node.span()) for node in root.children], expected)
+        self.assertEqual(root.hash(), Lines(stream=STRING).parse().hash())
+
+    def test_token_generator(self):
+        STRING = 'one two\n  three\n\nfour 4\n' * 10
+
+        expected = spans(Lines(stream=STRING).parse())
+
+        parser = Lines(tokens=iter(Lines(stream=STRING).buffer))
+        parser.buffer.history = 0
+        parser.buffer.batch = 4
+        self.assertEqual(spans(parser.parse()), expected)
+        self.assertLess(len(parser.buffer.items), 10)
+
+        # Lexed in blocks while parsing
+        with TemporaryDirectory() as tmp:
+            filepath = Path(tmp) / 'lines.txt'
+            filepath.write_text(STRING)
+            self.assertEqual(spans(Lines(filepath=filepath, block_size=8).parse()), expected)
+
+            # Without the whole source released nodes keep their own text
+            root = Lines(filepath=filepath, block_size=8, retain_tokens=False).parse()
+            self.assertEqual([(node.raw(), node.span()) for node in root.children],
+                             [(node.raw(), node.span()) for node in Lines(stream=STRING).parse().children])
+
+
+    def test_budget(self):
+        STRING = 'line\n' * 100
+
+        with self.assertRaises(Budget.ExceededException) as context:
+            Lines(stream=STRING).parse(Budget(max_nodes=10, interval=1))
+        self.assertEqual(context.exception.reason, 'nodes')
+        self.assertEqual(len(context.exception.partial.children), 10)
+
+        # Covers lexing as well
+        with self.assertRaises(Budget.ExceededException) as context:
+            Lines(stream=STRING, budget=Budget(timeout=0, interval=1))
+        self.assertEqual(context.exception.reason, 'timeout')
+
+        self.assertEqual(len(Lines(stream=STRING, budget=Budget(timeout=60, max_nodes=200)).parse().children), 100)
+
 
 class BinaryParserTest(TestCase):
     def test_blob(self):
@@ -70,3 +287,122 @@ class BinaryParserTest(TestCase):
                 parser.consumen(2)
                 num = BE(parser.collect_bytes())
                 doc.add(num)
+
+    def test_seek(self):
+        parser = BinaryParser(buffer=bytes(range(16)))
+
+        self.assertEqual(parser.seek(4), 4)
+        self.assertEqual(parser.byte(), 5)
+        self.assertEqual(parser.skip(2), 7)
+        self.assertEqual(parser.tell(), 7)
+        self.assertEqual(parser.seek(-2, 2), 14)
+        self.assertEqual(parser.bytes(4), bytearray([14, 15, 0, 0]))
+
+    def test_budget(self):
+        class Records(BinaryParser):
+            def parse_format(self):
+                while self:
+                    self.bytes(2)
+                    self.root.add(self.collect_view())
+                return self.root
+
+        with self.assertRaises(Budget.ExceededException) as context:
+            Records(buffer=bytes(200)).parse(Budget(max_nodes=5, interval=1))
+        self.assertEqual(context.exception.reason, 'nodes')
+        self.assertEqual(len(context.exception.partial.children), 5)
+
+        self.assertEqual(len(Records(buffer=bytes(200)).parse(Budget(max_nodes=100)).children), 100)
+
+        # Readers that do not collect nodes notice cancellation and deadlines
+        budget = Budget(interval=1)
+        parser = BinaryParser(buffer=bytes(100))
+        parser.parse_format = lambda: [parser.byte() for _ in range(100)]
+        budget.cancel()
+        with self.assertRaises(Budget.ExceededException) as context:
+            parser.parse(budget)
+        self.assertEqual(context.exception.reason, 'cancelled')
+        self.assertEqual(parser.tell(), 0)
+
+        parser = BinaryParser(buffer=bytes(100))
+        parser.parse_format = lambda: [parser.skip(1) for _ in range(100)]
+        with self.assertRaises(Budget.ExceededException) as context:
+            parser.parse(Budget(timeout=0, interval=1))
+        self.assertEqual(context.exception.reason, 'timeout')
+
+    def test_section(self):
+        parser = BinaryParser(buffer=bytes(range(16)))
+        section = parser.section(8, 4)
+
+        self.assertEqual(section.tell(), 0)
+        self.assertEqual(section.bytes(2), bytearray([8, 9]))
+        self.assertEqual(section.seek(0, 2), 4)
+        self.assertFalse(section)
+
+        nested = section.section(1, 8)
+        self.assertEqual(nested.bytes(3), bytearray([9, 10, 11]))
+        self.assertFalse(nested)
+
+    def test_lazy_nodes(self):
+        with TemporaryDirectory() as directory:
+            filepath = Path(directory) / 'blob.bin'
+            filepath.write_bytes(b'head' + bytes(range(8)) + b'tail')
+
+            parser = BinaryParser(filepath=filepath, mapped=True)
+            parser.seek(4)
+            parser.skip(8)
+            node = parser.collect_view()
+
+            self.assertEqual((node.offset, node.length), (4, 8))
+            self.assertEqual(node.bytes, bytes(range(8)))
+            self.assertEqual(node.hash(), BinaryNode(bytes(range(8))).hash())
+
+            parser.file.close()
+
+    def test_arrays(self):
+        ints = list(range(0, 60000, 7000))
+        floats = [0.5, -1.25, 3.0]
+        buffer = pack('<9H', *ints) + pack('>9I', *ints) + pack('<3q', 1, 2, 3) + pack('<3f', *floats) + pack('>3d', *floats)
+        parser = BinaryParser(buffer=buffer)
+
+        self.assertEqual(parser.int16_array(9), ints)
+        self.assertEqual(parser.int32_array(9, 'big'), ints)
+        self.assertEqual(parser.int64_array(3), [1, 2, 3])
+        self.assertEqual(parser.float32_array(3), floats)
+        self.assertEqual(list(parser.array('float64', 3, '>')), floats)
+        self.assertFalse(parser)
+
+        # Same results as the scalar readers
+        parser = BinaryParser(buffer=buffer)
+        self.assertEqual([parser.int16() for _ in range(9)], ints)
+
+    def test_window(self):
+        class Pipe:
+            # Readable without seek that returns short reads like a pipe
+            def __init__(self, data):
+                self.data = BytesIO(data)
+
+            def read(self, size = -1):
+                return self.data.read(min(size, 100))
+
+        records = b''.join(pack('<I', i) + bytes([i % 256]) * 16 for i in range(1000))
+        parser = BinaryParser(file=Pipe(records), window=256)
+
+        for i in range(1000):
+            self.assertEqual(parser.int32(), i)
+            parser.skip(12)
+            self.assertEqual(parser.bytes(4), bytearray([i % 256]) * 4)
+            self.assertLessEqual(len(parser.buffer.items), 1024)
+
+        self.assertFalse(parser)
+
+        parser = BinaryParser(file=Pipe(records), window=64)
+        parser.seek(4000)
+        parser.skip(40)
+        node = parser.collect_view()
+        self.assertEqual(node.bytes, records[4000:4040])
+
+        parser.skip(4000)
+        with self.assertRaises(IndexError):
+            parser.collect_bytes()
+        self.assertEqual(parser.seek(-20, 2), 19980)
+        self.assertEqual(parser.int32(), 999)
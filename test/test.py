@@ -1,8 +1,12 @@
 import unittest
 
+from test.parxel.test_corpus import CorpusTest
 from test.parxel.test_iterator import IteratorTest
 from test.parxel.test_lexer import LexerTest
+from test.parxel.test_memory import MemoryTest
+from test.parxel.test_nodes import NodeTest
 from test.parxel.test_parser import TextParserTest
+from test.test_md import LinkIndexTest, MDTest
 
 if __name__ == '__main__':
     unittest.main()
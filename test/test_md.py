@@ -0,0 +1,335 @@
+from md import MD, MDTK, Heading, Image, LinkIndex, Reference, Table, Text
+from parxel.corpus import Corpus
+from parxel.nodes import LexicalNode, NodeTable
+from parxel.parser import Event, EventHandler, EventQueue
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import os
+
+
+SAMPLE = '''# Title [link](a.md)
+
+Plain text line.
+Second plain line.
+
+- item one
+- item [two](b.md)
+
+Text after a list.
+## Heading
+Line after a heading.
+    indented line
+\ttab led line
+
+| a | b | c |
+|:---:|---:|---|
+| `x` | y | [z](c.md) |
+
+| left | right |
+|---|---:|
+| [w](g.md) | 2 |
+
+```
+code
+
+with blank lines
+```
+
+Some `inline
+
+code` across a blank line.
+
+A [reference
+text](d.md) across lines and ![image](e.png).
+
+A [reference
+
+text](f.md) across a blank line.
+
+- last
+  - nested
+
+Final text.
+'''
+
+
+def shape(root, tokens: bool = True) -> list:
+    # Types, texts and token positions of the nodes below root, or only their spans
+    nodes = []
+    for node in list(root.walk())[1:]:
+        entry = [node.type(), len(node.children)]
+        if isinstance(node, LexicalNode):
+            entry.append(node.raw())
+            if tokens:
+                entry.append([(token.beg, token.row, token.col, token.text) for token in node.tokens or []])
+            else:
+                entry.append(node.span())
+        nodes.append(entry)
+    return nodes
+
+
+def placeholders(root) -> list:
+    return [child for node in root.walk_built() for child in node.children if 'builder' in child.__dict__]
+
+
+def tables_of(root) -> list:
+    # Top level tables, placeholders are not built
+    return [node for node in root.children if isinstance(node, Table)]
+
+
+def tables(root) -> list:
+    return [(node.columns, node.cell_alignment, shape(node)) for node in root.walk() if isinstance(node, Table)]
+
+
+class Tokenized(MD):
+    # Without the fast path for plain lines
+    def prescan(self, stream: str) -> None:
+        return None
+
+
+class MDTest(TestCase):
+    def test_parse_parallel(self):
+        stream = SAMPLE * 4
+        expected = shape(MD(stream=stream).parse())
+
+        # Small chunks split at every block boundary
+        self.assertGreater(len(MD.split_blocks(stream)), 4 * 8)
+        for workers in (1, 2):
+            self.assertEqual(shape(MD.parse_parallel(stream=stream, chunk_size=64, workers=workers)), expected)
+
+        with TemporaryDirectory() as directory:
+            filepath = Path(directory) / 'sample.md'
+            filepath.write_text(stream)
+
+            root = MD.parse_parallel(filepath=str(filepath), chunk_size=64, workers=1)
+            self.assertEqual(root.filepath, filepath)
+            self.assertEqual(shape(root), expected)
+
+    def test_prescan(self):
+        stream = SAMPLE * 2
+        root = MD(stream=stream).parse()
+
+        plain = [node.raw() for node in root.walk()
+                 if isinstance(node, Text) and [token.type for token in node.tokens] == [MDTK.PlainText]]
+        self.assertIn('Plain text line.', plain)
+        self.assertIn('Text after a list.', plain)
+
+        # Plain lines lexed as single tokens give the same tree
+        self.assertEqual(shape(root, tokens=False), shape(Tokenized(stream=stream).parse(), tokens=False))
+
+    def test_events(self):
+        class Levels(EventHandler):
+            def __init__(self):
+                self.levels = []
+
+            def enter(self, node):
+                if isinstance(node, Heading):
+                    self.levels.append(node.level)
+
+        handler = Levels()
+        MD(stream='## Two\n\n### Three\n', events=handler).parse()
+        self.assertEqual(handler.levels, [2, 3])
+
+        # Alignment rows are not passed on, events match the nodes of the tree
+        events = EventQueue()
+        MD(stream=SAMPLE, events=events).parse()
+        nodes = [node for kind, node in events.drain() if kind != Event.Leave]
+        tree = list(MD(stream=SAMPLE).parse().walk())[1:]
+        self.assertEqual([node.type() for node in nodes], [node.type() for node in tree])
+        self.assertNotIn(':---:', [node.text for node in nodes if isinstance(node, Text)])
+
+    def test_node_table_release_tokens(self):
+        # Tokens are released before nodes are shared, shared nodes keep the source of their document
+        for parse in (lambda stream, **options: MD(stream=stream, **options).parse(),
+                      lambda stream, **options: MD.parse_parallel(stream=stream, workers=1, **options)):
+            table = NodeTable()
+            first = parse('Hello world.\n', node_table=table)
+            second = parse('Intro line here.\n\nHello world.\n', node_table=table, retain_tokens=False)
+
+            self.assertIs(second.children[-1], first.children[0])
+            self.assertEqual(first.children[0].raw(), 'Hello world.')
+            self.assertEqual([node.raw() for node in second.children if isinstance(node, Text)],
+                             ['Intro line here.', 'Hello world.'])
+
+    def test_lazy(self):
+        stream = SAMPLE * 2
+        eager = MD(stream=stream).parse()
+        lazy = MD(stream=stream, lazy=True).parse()
+
+        # Tables without code are built on access, with the same columns, alignment and token positions
+        self.assertTrue(placeholders(lazy))
+        self.assertEqual(len(tables(eager)), 4)
+        self.assertEqual(tables(lazy), tables(eager))
+        self.assertFalse(placeholders(lazy))
+        self.assertEqual(shape(lazy, tokens=False), shape(eager, tokens=False))
+
+    def test_lazy_diff(self):
+        stream = SAMPLE * 2
+        old = MD(stream=stream, lazy=True).parse()
+        new = MD(stream='Preface.\n\n' + stream, lazy=True).parse()
+
+        # Tables moved by an edit are unchanged
+        diff = old.diff(new)
+        self.assertEqual((len(diff.inserted), len(diff.changed), len(diff.removed)), (1, 0, 0))
+        self.assertTrue(placeholders(old))
+        self.assertEqual(len(placeholders(new)), 2)
+
+    def test_lazy_node_at(self):
+        stream = SAMPLE * 3
+        eager = MD(stream=stream).parse()
+        lazy = MD(stream=stream, lazy=True).parse()
+
+        def located(node):
+            return None if node is None else (node.type(), node.span())
+
+        # Placeholders are built where their extent is hit, the extent includes the outer bars of the table
+        self.assertEqual([located(lazy.node_at(offset)) for offset in range(len(stream) + 1)],
+                         [located(eager.node_at(offset)) for offset in range(len(stream) + 1)])
+
+        lazy = MD(stream=stream, lazy=True).parse()
+        for beg in range(0, len(stream), 7):
+            self.assertEqual([located(node) for node in lazy.nodes_in_range(beg, beg + 9)],
+                             [located(node) for node in eager.nodes_in_range(beg, beg + 9)])
+
+    def test_lazy_release_tokens(self):
+        stream = SAMPLE * 2
+        root = MD(stream=stream, lazy=True, retain_tokens=False).parse()
+
+        # Placeholders are left alone and release the tokens of their nodes when built
+        self.assertTrue(placeholders(root))
+        self.assertEqual(shape(root, tokens=False), shape(MD(stream=stream).parse(), tokens=False))
+        self.assertTrue(all(node.tokens is None for node in root.walk() if isinstance(node, LexicalNode)))
+
+    def test_lazy_node_table(self):
+        stream = SAMPLE * 2
+        table = NodeTable()
+        root = MD(stream=stream, lazy=True, node_table=table).parse()
+
+        # Placeholders are fingerprinted by their text without building them, identical tables are shared
+        self.assertTrue(placeholders(root))
+        self.assertGreater(table.hits, 0)
+        self.assertIs(tables_of(root)[1], tables_of(root)[3])
+        fingerprint = root.fingerprint()
+        self.assertTrue(placeholders(root))
+        self.assertEqual(fingerprint, MD(stream=stream, lazy=True).parse().fingerprint())
+        self.assertNotEqual(fingerprint, MD(stream=stream.replace('| 2 |', '| 3 |'), lazy=True).parse().fingerprint())
+
+        # Across documents at other offsets
+        hits = table.hits
+        other = MD(stream='Preface.\n\n' + SAMPLE, lazy=True, node_table=table).parse()
+        self.assertIs(tables_of(other)[1], tables_of(root)[1])
+        self.assertGreater(table.hits, hits)
+
+        eager = MD(stream=stream, node_table=NodeTable()).parse()
+        self.assertEqual([(columns, alignment) for columns, alignment, _ in tables(root)],
+                         [(columns, alignment) for columns, alignment, _ in tables(eager)])
+        self.assertEqual(root.hash(), eager.hash())
+
+
+class LinkIndexTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = Path(self.directory.name)
+
+        (self.path / 'sub').mkdir()
+        (self.path / 'a.md').write_text('[b](sub/b.md) and [gone](missing.md) and [web](https://x.org)\n')
+        (self.path / 'sub' / 'b.md').write_text('[a](../a.md) and ![pic](/a.md)\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def parse(self, links: LinkIndex, name: str) -> MD:
+        return MD(filepath=self.path / name, links=links).parse()
+
+    def test_parse(self):
+        links = LinkIndex(root=self.path)
+        root = self.parse(links, 'a.md')
+        self.parse(links, 'sub/b.md')
+
+        # Filled while parsing
+        self.assertEqual(len(links), 5)
+        self.assertEqual(links.links(self.path / 'a.md'),
+                         [node for node in root.walk() if isinstance(node, (Reference, Image))])
+
+        # Parsing a file again replaces its links
+        (self.path / 'a.md').write_text('[b](sub/b.md)\n')
+        self.parse(links, 'a.md')
+        self.assertEqual(len(links), 3)
+        self.assertEqual([node.target for node in links.links(self.path / 'a.md')], ['sub/b.md'])
+        self.assertEqual(links.linking('missing.md'), [])
+        self.assertNotIn(self.path / 'missing.md', links.paths)
+
+    def test_lookup(self):
+        links = LinkIndex(root=self.path)
+        self.parse(links, 'a.md')
+        self.parse(links, 'sub/b.md')
+
+        # Paths are resolved relative to the linking document, or to the root if absolute
+        self.assertEqual(links.referrers(self.path / 'a.md'), {self.path / 'sub' / 'b.md'})
+        self.assertEqual(links.referrers(self.path / 'sub' / '..' / 'sub' / 'b.md'), {self.path / 'a.md'})
+        self.assertEqual(sorted(node.target for node in links.linking(self.path / 'a.md')), ['../a.md', '/a.md'])
+
+        # Raw targets are matched as written, external ones are not resolved
+        self.assertEqual([node.text for node in links.linking('../a.md')], ['a'])
+        self.assertEqual(links.referrers('https://x.org'), {self.path / 'a.md'})
+        self.assertEqual(links.linking('a.md'), [])
+        self.assertEqual(links.referrers('unknown.md'), set())
+
+    def test_broken(self):
+        links = LinkIndex(root=self.path)
+        self.parse(links, 'a.md')
+        self.parse(links, 'sub/b.md')
+
+        # Against the file system
+        self.assertEqual([node.target for node in links.broken()], ['missing.md'])
+
+        # Against a list of files
+        files = [self.path / 'a.md', self.path / 'missing.md']
+        self.assertEqual([node.target for node in links.broken(files)], ['sub/b.md'])
+
+    def test_update(self):
+        links = LinkIndex(root=self.path)
+        corpus = Corpus(self.path, lambda filepath: MD(filepath=filepath, links=links).parse())
+
+        links.update(corpus.refresh())
+        self.assertEqual(len(links), 5)
+
+        # Changed files were parsed again, removed ones are forgotten
+        (self.path / 'a.md').write_text('[b](sub/b.md)\n')
+        os.utime(self.path / 'a.md', ns=(1, 1))
+        links.update(corpus.refresh())
+        self.assertEqual(len(links), 3)
+
+        (self.path / 'sub' / 'b.md').unlink()
+        links.update(corpus.refresh())
+        self.assertEqual(len(links), 1)
+        self.assertEqual(links.referrers(self.path / 'sub' / 'b.md'), {self.path / 'a.md'})
+        self.assertEqual([node.target for node in links.broken()], ['sub/b.md'])
+
+    def test_lazy(self):
+        stream = '| a | b |\n|---|---|\n| [c](c.md) | d |\n\n| e | f |\n|---|---|\n| g | h |\n'
+        links = LinkIndex()
+        root = MD(stream=stream, lazy=True, links=links).parse()
+
+        # Tables with links are parsed right away to index them
+        self.assertEqual([node.target for node in links.links(None)], ['c.md'])
+        self.assertEqual(len(placeholders(root)), 1)
+
+    def test_parse_parallel(self):
+        stream = SAMPLE * 4
+        expected = LinkIndex()
+        MD(stream=stream, links=expected).parse()
+
+        links = LinkIndex()
+        MD.parse_parallel(stream=stream, chunk_size=64, workers=1, links=links)
+        self.assertEqual([(node.target, node.span()) for node in links.links(None)],
+                         [(node.target, node.span()) for node in expected.links(None)])
+
+        # Files parsed again replace their links
+        filepath = self.path / 'a.md'
+        links = LinkIndex()
+        for _ in range(2):
+            MD.parse_parallel(filepath=filepath, chunk_size=4, workers=1, links=links)
+            self.assertEqual(len(links), 3)
+            self.assertEqual(links.referrers(self.path / 'sub' / 'b.md'), {filepath})